@@ -1,4 +1,10 @@
-import lcnn.models
-import lcnn.trainer
-import lcnn.datasets
-import lcnn.config
+import importlib
+
+# Submodules are imported on first use so that light users (e.g. lcnn.postprocess)
+# do not pull in torch, matplotlib and tensorboardX.
+_SUBMODULES = ("models", "trainer", "datasets", "config", "utils", "metric", "postprocess", "box")
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module("lcnn." + name)
+    raise AttributeError("module 'lcnn' has no attribute '{}'".format(name))
@@ -159,7 +159,15 @@ class HourglassNet(nn.Module):
         conv = nn.Conv2d(inplanes, outplanes, kernel_size=1)
         return nn.Sequential(conv, bn, self.relu)
 
-    def forward(self, x):
+    def forward(self, x, final_only=False):
+        """
+        Returns the head outputs of every stack (last stack first) and the feature
+        map of the last stack.
+
+        If final_only is True only the last stack's head output is returned. Every
+        stack still runs because each one feeds the next, but intermediate head
+        outputs are released as soon as they have been folded into the next stack.
+        """
         out = []
         # out_vps = []
         x = self.conv1(x)
@@ -179,7 +187,8 @@ class HourglassNet(nn.Module):
             # pre_vpts = F.adaptive_avg_pool2d(x, (1, 1))
             # pre_vpts = pre_vpts.reshape(-1, 256)
             # vpts = self.vpts[i](x)
-            out.append(score)
+            if not final_only or i == self.num_stacks - 1:
+                out.append(score)
             # out_vps.append(vpts)
             if i < self.num_stacks - 1:
                 fc_ = self.fc_[i](y)
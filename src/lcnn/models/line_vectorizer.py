@@ -13,9 +13,16 @@ FEATURE_DIM = 8
 
 
 class LineVectorizer(nn.Module):
-    def __init__(self, backbone):
+    def __init__(self, backbone, compact=False):
+        """
+        If compact is True, non-training predictions are lists of per-image tensors
+        holding only the detected lines, scores and junctions, with their counts in
+        "n_lines" and "n_juncs". Otherwise they are padded to M.n_out_line and
+        M.n_out_junc by repeating entries.
+        """
         super().__init__()
         self.backbone = backbone
+        self.compact = compact
 
         lambda_ = torch.linspace(0, 1, M.n_pts0)[:, None]
         self.register_buffer("lambda_", lambda_)
@@ -95,7 +102,31 @@ class LineVectorizer(nn.Module):
         x = torch.cat([x, f], 1)
         x = self.fc2(x).flatten()
 
-        if input_dict["mode"] != "training":
+        if input_dict["mode"] != "training" and self.compact:
+            p = torch.cat(ps)
+            s = torch.sigmoid(x)
+            b = s > 0.5
+            lines = []
+            score = []
+            for i in range(n_batch):
+                p0 = p[idx[i] : idx[i + 1]]
+                s0 = s[idx[i] : idx[i + 1]]
+                mask = b[idx[i] : idx[i + 1]]
+                p0 = p0[mask]
+                s0 = s0[mask]
+                arg = torch.argsort(s0, descending=True)[: M.n_out_line]
+                lines.append(p0[arg])
+                score.append(s0[arg])
+                for j in range(len(jcs[i])):
+                    jcs[i][j] = jcs[i][j][: M.n_out_junc]
+            result["preds"]["lines"] = lines
+            result["preds"]["score"] = score
+            result["preds"]["juncs"] = [jcs[i][0] for i in range(n_batch)]
+            result["preds"]["n_lines"] = torch.tensor([len(l) for l in lines])
+            result["preds"]["n_juncs"] = torch.tensor([len(jcs[i][0]) for i in range(n_batch)])
+            if len(jcs[0]) > 1:
+                result["preds"]["junts"] = [jcs[i][1] for i in range(n_batch)]
+        elif input_dict["mode"] != "training":
             p = torch.cat(ps)
             s = torch.sigmoid(x)
             b = s > 0.5
@@ -39,10 +39,18 @@ class MultitaskLearner(nn.Module):
 
     def forward(self, input_dict):
         image = input_dict["image"]
-        outputs, feature = self.backbone(image)
+        testing = input_dict["mode"] == "testing"
+        # Only the last stack's output (stack 0 below) is used when testing
+        outputs, feature = self.backbone(image, final_only=testing)
         result = {"feature": feature}
         batch, channel, row, col = outputs[0].shape
 
+        if testing:
+            n_jtyp = int(self.head_off[0]) // 2
+            output = outputs[0].transpose(0, 1).reshape([-1, batch, row, col]).contiguous()
+            result["preds"] = self.predictions(output, n_jtyp, batch, row, col)
+            return result
+
         T = input_dict["target"].copy()
         n_jtyp = T["jmap"].shape[1]
 
@@ -61,13 +69,7 @@ class MultitaskLearner(nn.Module):
             lmap = output[offset[0] : offset[1]].squeeze(0)
             joff = output[offset[1] : offset[2]].reshape(n_jtyp, 2, batch, row, col)
             if stack == 0:
-                result["preds"] = {
-                    "jmap": jmap.permute(2, 0, 1, 3, 4).softmax(2)[:, :, 1],
-                    "lmap": lmap.sigmoid(),
-                    "joff": joff.permute(2, 0, 1, 3, 4).sigmoid() - 0.5,
-                }
-                if input_dict["mode"] == "testing":
-                    return result
+                result["preds"] = self.predictions(output, n_jtyp, batch, row, col)
 
             L = OrderedDict()
             L["jmap"] = sum(
@@ -89,6 +91,17 @@ class MultitaskLearner(nn.Module):
         result["losses"] = losses
         return result
 
+    def predictions(self, output, n_jtyp, batch, row, col):
+        offset = self.head_off
+        jmap = output[0 : offset[0]].reshape(n_jtyp, 2, batch, row, col)
+        lmap = output[offset[0] : offset[1]].squeeze(0)
+        joff = output[offset[1] : offset[2]].reshape(n_jtyp, 2, batch, row, col)
+        return {
+            "jmap": jmap.permute(2, 0, 1, 3, 4).softmax(2)[:, :, 1],
+            "lmap": lmap.sigmoid(),
+            "joff": joff.permute(2, 0, 1, 3, 4).sigmoid() - 0.5,
+        }
+
 
 def l2loss(input, target):
     return ((target - input) ** 2).mean(2).mean(1)
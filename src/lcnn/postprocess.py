@@ -1,3 +1,5 @@
+from collections import defaultdict
+
 import numpy as np
 
 
@@ -28,7 +30,8 @@ def plambda(x1, y1, x2, y2, x, y):
     return ((x - x1) * px + (y - y1) * py) / max(1e-9, float(dd))
 
 
-def postprocess(lines, scores, threshold=0.01, tol=1e9, do_clip=False):
+def postprocess_reference(lines, scores, threshold=0.01, tol=1e9, do_clip=False):
+    """Reference implementation of postprocess, comparing every pair of lines in python."""
     nlines, nscores = [], []
     for (p, q), score in zip(lines, scores):
         start, end = 0, 1
@@ -75,3 +78,172 @@ def postprocess(lines, scores, threshold=0.01, tol=1e9, do_clip=False):
         nlines.append(np.array([p + (q - p) * start, p + (q - p) * end]))
         nscores.append(score)
     return np.array(nlines), np.array(nscores)
+
+
+def postprocess(lines, scores, threshold=0.01, tol=1e9, do_clip=False, grid_size=16):
+    """
+    Removes lines that overlap with higher scoring lines, clipping partially covered lines.
+
+    Gives the same output as postprocess_reference. Each candidate line is compared with
+    the accepted lines in one vectorized step, and only the few accepted lines that pass
+    the distance test are walked in order. When tol is small enough, accepted lines are
+    bucketed into a grid so that only lines near the candidate are compared.
+
+    Arguments:
+    lines -- numpy array [N, 2, 2] sorted by descending score
+    scores -- numpy array [N]
+    threshold -- maximum distance between overlapping lines
+    tol -- slack on the overlap interval, in units of the candidate line length
+    grid_size -- number of grid cells along the longer image side (0 disables the grid)
+
+    Returns:
+    nlines -- numpy array [M, 2, 2] of kept (possibly clipped) lines
+    nscores -- numpy array [M] of their scores
+    """
+    lines = np.asarray(lines)
+    n = len(lines)
+    if n == 0:
+        return np.array([]), np.array([])
+
+    accepted = np.zeros((n, 2, 2))
+    nlines, nscores = [], []
+
+    # A pair can only interact if the accepted line passes within radius of the candidate
+    # segment extended by tol on both sides. This holds whenever the candidate is longer than
+    # min_length (see _interaction_radius); shorter candidates are compared with every line.
+    radius, min_length = _interaction_radius(threshold, tol)
+    grid = None
+    if grid_size > 0 and np.isfinite(radius):
+        lo = lines.reshape(-1, 2).min(0)
+        hi = lines.reshape(-1, 2).max(0)
+        cell = max((hi - lo).max() / grid_size, radius, 1e-9)
+        grid = _SegmentGrid(lo, hi, cell)
+
+    for (p, q), score in zip(lines, scores):
+        start, end = 0, 1
+        num_accepted = len(nlines)
+        if num_accepted > 0:
+            length = np.sqrt(float(np.sum((q - p) ** 2)))
+            if grid is None or length < min_length:
+                idx = np.arange(num_accepted)
+            else:
+                ext = (q - p) * tol
+                lo = np.minimum(p - ext, q + ext) - radius
+                hi = np.maximum(p - ext, q + ext) + radius
+                idx = grid.query(lo, hi)
+
+            a = accepted[idx, 0]
+            b = accepted[idx, 1]
+            d_pq = np.maximum(_pline(p, q, a), _pline(p, q, b))
+            d_ab = np.maximum(_pline(a, b, p), _pline(a, b, q))
+            close = ~(np.minimum(d_pq, d_ab) > threshold ** 2)
+            idx = idx[close]
+            lambda_as = _plambda(p, q, a[close])
+            lambda_bs = _plambda(p, q, b[close])
+
+            for lambda_a, lambda_b in zip(lambda_as, lambda_bs):
+                if lambda_a > lambda_b:
+                    lambda_a, lambda_b = lambda_b, lambda_a
+                lambda_a -= tol
+                lambda_b += tol
+
+                # case 1: skip (if not do_clip)
+                if start < lambda_a and lambda_b < end:
+                    continue
+
+                # not intersect
+                if lambda_b < start or lambda_a > end:
+                    continue
+
+                # cover
+                if lambda_a <= start and end <= lambda_b:
+                    start = 10
+                    break
+
+                # case 2 & 3:
+                if lambda_a <= start and start <= lambda_b:
+                    start = lambda_b
+                if lambda_a <= end and end <= lambda_b:
+                    end = lambda_a
+
+                if start >= end:
+                    break
+
+        if start >= end:
+            continue
+        line = np.array([p + (q - p) * start, p + (q - p) * end])
+        accepted[len(nlines)] = line
+        if grid is not None:
+            grid.add(len(nlines), line.min(0), line.max(0))
+        nlines.append(line)
+        nscores.append(score)
+    return np.array(nlines), np.array(nscores)
+
+
+def _pline(p, q, x):
+    """Vectorized pline: squared distance from x to the infinite line through p, q."""
+    x1, y1 = p[..., 0], p[..., 1]
+    px = q[..., 0] - x1
+    py = q[..., 1] - y1
+    dd = px * px + py * py
+    u = ((x[..., 0] - x1) * px + (x[..., 1] - y1) * py) / np.maximum(1e-9, dd)
+    dx = x1 + u * px - x[..., 0]
+    dy = y1 + u * py - x[..., 1]
+    return dx * dx + dy * dy
+
+
+def _plambda(p, q, x):
+    """Vectorized plambda: parameter of the projection of x onto the line p -> q."""
+    x1, y1 = p[..., 0], p[..., 1]
+    px = q[..., 0] - x1
+    py = q[..., 1] - y1
+    dd = px * px + py * py
+    return ((x[..., 0] - x1) * px + (x[..., 1] - y1) * py) / np.maximum(1e-9, dd)
+
+
+def _interaction_radius(threshold, tol):
+    """
+    Returns (radius, min_length) such that an accepted line can only change a candidate of
+    length >= min_length if it passes within radius of the candidate extended by tol.
+
+    Either both accepted endpoints lie within threshold of the candidate line, or both
+    candidate endpoints lie within threshold of the accepted line. In the second case the
+    lines meet at an angle with sin <= 2 * threshold / length, so for length >= 2 * sqrt(2)
+    * threshold the accepted line stays within sqrt(2) * threshold * (1 + 2 * tol) of the
+    extended candidate over the overlap interval.
+    """
+    if not np.isfinite(tol) or tol > 1:
+        return np.inf, np.inf
+    radius = np.sqrt(2) * threshold * (1 + 2 * max(tol, 0))
+    # Small margin for rounding
+    return radius * 1.01 + 1e-6, 2 * np.sqrt(2) * threshold
+
+
+class _SegmentGrid(object):
+    """Uniform grid of cells holding the indices of segments whose bounding box covers them."""
+
+    def __init__(self, origin, corner, cell):
+        self.origin = origin
+        self.cell = cell
+        self.shape = np.floor((corner - origin) / cell).astype(int)
+        self.cells = defaultdict(list)
+
+    def _range(self, lo, hi):
+        # All segments lie inside [origin, corner] so cells outside it are always empty
+        i0, j0 = np.clip(np.floor((lo - self.origin) / self.cell).astype(int), 0, self.shape)
+        i1, j1 = np.clip(np.floor((hi - self.origin) / self.cell).astype(int), 0, self.shape)
+        return i0, j0, i1, j1
+
+    def add(self, index, lo, hi):
+        i0, j0, i1, j1 = self._range(lo, hi)
+        for i in range(i0, i1 + 1):
+            for j in range(j0, j1 + 1):
+                self.cells[i, j].append(index)
+
+    def query(self, lo, hi):
+        """Returns the sorted indices of segments in cells overlapping the box [lo, hi]."""
+        i0, j0, i1, j1 = self._range(lo, hi)
+        found = [self.cells[i, j] for i in range(i0, i1 + 1) for j in range(j0, j1 + 1) if (i, j) in self.cells]
+        if not found:
+            return np.zeros(0, dtype=int)
+        return np.unique(np.concatenate(found).astype(int))
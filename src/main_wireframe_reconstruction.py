@@ -1,20 +1,11 @@
 import argparse
 import os
 
-import matplotlib.pyplot as plt
 import wireframe
 import wireframe_run_ply
 import myply
-import skimage.io
 import numpy as np
 
-def load_image(imname):
-    im = skimage.io.imread(imname)
-    if im.ndim == 2:
-        im = np.repeat(im[:, :, None], 3, 2)
-    im = im[:, :, :3]
-    return im
-
 class ArgSet():
 
     def __init__(self):
@@ -26,54 +17,39 @@ class Match():
         self.ply = ply
         self.labels = labels
 
-    def plot_matches(self, proj_dir, initial_lines, batch=9):
-        linenums = [l[1] for l in self.labels]
-        imnums = [l[0] for l in self.labels]
-        images = ["img_{}.png".format(l[0]) for l in self.labels]
-        idx = 0
-        while len(images[idx:]) >= batch:
-            if batch % 3 == 0:
-                fig, axes = plt.subplots(3, int(batch / 3))
-                step = 3
+    def plot_matches(self, proj_dir, initial_lines, batch=9, renderer=None, name="match"):
+        """
+        Plots the initial line of every label over its image, batch images per figure
+
+        Arguments:
+        proj_dir -- project directory with the images
+        initial_lines -- dict from imnum -> initial lines of that image
+        batch -- number of images per figure (default 9)
+        renderer -- (optional) WireframeRenderer to queue figures on instead of showing them
+        name -- filename prefix for rendered figures (default "match")
+        """
+        from wireframe.wireframe_render import render_panels
+
+        panels = []
+        for imnum, linenum in self.labels:
+            l = initial_lines[imnum][linenum]
+            panels.append({"image": os.path.join(proj_dir, "images", "img_{}.png".format(imnum)),
+                           "segments": np.asarray(l)[None, :, :2]})
+
+        for figure, idx in enumerate(range(0, len(panels), batch)):
+            fig_panels = panels[idx:idx + batch]
+            if len(fig_panels) < batch:
+                shape = (1, len(fig_panels))
+            elif batch % 3 == 0:
+                shape = (3, batch // 3)
             elif batch % 2 == 0:
-                fig, axes = plt.subplots(2, int(batch / 2))
-                step = 2
+                shape = (2, batch // 2)
             else:
-                fig, axes = plt.subplots(1, batch)
-                step = 1
-            for i in range(batch):
-                im = load_image(os.path.join(proj_dir, "images", images[idx + i]))
-                l = initial_lines[imnums[idx + i]][linenums[idx + i]]
-                if step == 1:
-                    axes[i].imshow(im)
-                    axes[i].plot([l[0, 0], l[1, 0]], [l[0, 1], l[1, 1]], c='r', linewidth=2)
-                else:
-                    axes[int(i / step), i % step].imshow(im)
-                    axes[int(i / step), i % step].plot([l[0, 0], l[1, 0]], [l[0, 1], l[1, 1]], c='r', linewidth=2)
-            plt.gca().xaxis.set_major_locator(plt.NullLocator())
-            plt.gca().yaxis.set_major_locator(plt.NullLocator())
-            plt.show()
-            plt.close()
-            idx += batch
-
-        if len(images[idx:]) == 0:
-            return
-
-        batch = len(images[idx:])
-        fig, axes = plt.subplots(1, batch)
-        for i in range(batch):
-            im = load_image(os.path.join(proj_dir, "images", images[idx + i]))
-            l = initial_lines[imnums[idx + i]][linenums[idx + i]]
-            if batch == 1:
-                axes.imshow(im)
-                axes.plot([l[0, 0], l[1, 0]], [l[0, 1], l[1, 1]], c='r', linewidth=2)
+                shape = (1, batch)
+            if renderer is not None:
+                renderer.submit("{}_{}.png".format(name, figure), fig_panels, shape)
             else:
-                axes[i].imshow(im)
-                axes[i].plot([l[0, 0], l[1, 0]], [l[0, 1], l[1, 1]], c='r', linewidth=2)
-        plt.gca().xaxis.set_major_locator(plt.NullLocator())
-        plt.gca().yaxis.set_major_locator(plt.NullLocator())
-        plt.show()
-        plt.close()
+                render_panels(fig_panels, shape)
 
 def main(args):
 
@@ -85,93 +61,118 @@ def main(args):
     w_args.reconstruction = 0
     w_args.score_thresh = 0.95
     w_args.device = args.device
+    w_args.batch_size = 1
+    w_args.procs = 1
+    w_args.cache_model = False
+    w_args.use_store = args.use_store
+    w_args.decode_workers = 4
+    w_args.ply_procs = args.ply_procs
 
     wpcs, records = wireframe_run_ply.main(w_args)
     record_dict = {}
     for r in records.values():
         record_dict[r.imnum] = r
 
-    all_images = {}
-    # list of (imname, imnum, ply) objects from all wpcs
-    all_plys = []
-    # dict from (imnum, linenum) -> ply
-    plys_by_im_line = {}
-    all_initial_lines = {}
-    for wpc in wpcs:
-        for imnum, imline, ply in wpc.get_plys():
-            if all_images.get(imnum, None) is None:
-                all_images[imnum] = load_image(os.path.join(args.project_directory, "images", "img_{}.png".format(imnum)))
-            plys_by_im_line[(imnum, imline)] = ply
-        all_plys += wpc.get_plys()
-        all_initial_lines[wpc.imnum] = wpc.initial_lines
-
-
-    merged = myply.PLY(None, None, None)
-    for imname, imline, ply in all_plys:
-        merged.combine(ply)
-
-    merged.write(os.path.join(args.project_directory, "merged_wireframe.ply"))
-    corner = np.array([10, 10, 10])
-    merged.enforce_bounding_box(-corner, corner)
-    print("Wrote merged_wireframe.ply...")
-
-    # Predicts and enforces the manhattan constraint
-    manhattan = myply.PLYEdge(merged)
-    manhattan.assert_basis_directions(1000, 0.18)
-    basis_directions = manhattan.v
-    manhattan.write(os.path.join(args.project_directory, "manhattan_wireframe.ply"))
-    print("Wrote manhattan_wireframe.ply...")
-
-    filtered_by_distance = manhattan.get_nearby_lines(tol=args.tol, min_group=args.min_group)
-    combined = myply.PLY(None, None, None)
-    matches = []
-    count = 0
-    for p in filtered_by_distance:
-        print("Combining filtered line {}...".format(count))
-        e = myply.PLYEdge(myply.PLY(None, None, None))
-        for label in p.edge_labels:
-            e.combine(plys_by_im_line[label])
-
-        d = np.argmax(np.abs(np.dot(e.edges[0].direction(), basis_directions.transpose())))
-        direction = basis_directions[d]
-        fname = "complex_{}.ply".format(count)
-        e.write(os.path.join(args.project_directory, "wireframe_ply", fname))
-        e.combine_edges_with_direction(direction)
-        e.remove_all_vertices()
-        combined.combine(e)
-        fname = "simplified_{}.ply".format(count)
-        count += 1
-        print("Showing matches for {}".format(fname))
-        e.write(os.path.join(args.project_directory, "wireframe_ply", fname))
-        matches.append(Match(e, p.edge_labels))
-        if args.plot1:
-            matches[-1].plot_matches(args.project_directory, all_initial_lines)
-
-    combined.write(os.path.join(args.project_directory, "wireframe_simplified.ply"))
-
-    # Each match stores the edge e and the labels (imnum, imname) for that edge in each image
-    # Adjacencies goes from index in matches -> list of groups of matches
-    # group matches all correspond to a single intersection point
-    adjacencies = {}
-
-    for ei, m in enumerate(matches):
-        print('Processing {}th match'.format(ei))
-        # Find all other matches incident with this one
-        adjacencies[ei] = []
-        for imnum, linenum in m.labels:
-            g = wireframe.WireframeGraph(record_dict[imnum], threshold=w_args.score_thresh)
-            intersecting_linenums = g.get_intersecting_lines(linenum)
-            for group in intersecting_linenums:
-                group_matches = []
-                if args.plot2:
-                    g.plot_graph(g.g, all_images[imnum], highlight=group + [linenum])
-                for other_linenum in group:
-                    label = (imnum, other_linenum)
-                    for other_ei, other_m in enumerate(matches):
-                        if (label in other_m.labels):
-                            group_matches.append(other_ei)
-                adjacencies[ei].append(group_matches)
-
+    # Figures are queued on a pool of Agg renderers in headless mode instead of shown
+    renderer = None
+    if args.headless and (args.plot1 or args.plot2):
+        renderer = wireframe.WireframeRenderer(os.path.join(args.project_directory, "wireframe_plots"),
+                                               num_procs=args.render_procs)
+
+    try:
+        # dict from imnum -> image filename, images are loaded by the plotting code
+        all_images = {}
+        # list of (imname, imnum, ply) objects from all wpcs
+        all_plys = []
+        # dict from (imnum, linenum) -> ply
+        plys_by_im_line = {}
+        all_initial_lines = {}
+        for wpc in wpcs:
+            for imnum, imline, ply in wpc.get_plys():
+                if args.plot2 and all_images.get(imnum, None) is None:
+                    all_images[imnum] = os.path.join(args.project_directory, "images", "img_{}.png".format(imnum))
+                plys_by_im_line[(imnum, imline)] = ply
+            all_plys += wpc.get_plys()
+            all_initial_lines[wpc.imnum] = wpc.initial_lines
+
+
+        merged = myply.PLY(None, None, None)
+        for imname, imline, ply in all_plys:
+            merged.combine(ply)
+
+        merged.write(os.path.join(args.project_directory, "merged_wireframe.ply"))
+        corner = np.array([10, 10, 10])
+        merged.enforce_bounding_box(-corner, corner)
+        print("Wrote merged_wireframe.ply...")
+
+        # Predicts and enforces the manhattan constraint
+        manhattan = myply.PLYEdge(merged)
+        manhattan.assert_basis_directions(1000, 0.18)
+        basis_directions = manhattan.v
+        manhattan.write(os.path.join(args.project_directory, "manhattan_wireframe.ply"))
+        print("Wrote manhattan_wireframe.ply...")
+
+        filtered_by_distance = manhattan.get_nearby_lines(tol=args.tol, min_group=args.min_group)
+        combined = myply.PLY(None, None, None)
+        matches = []
+        count = 0
+        for p in filtered_by_distance:
+            print("Combining filtered line {}...".format(count))
+            e = myply.PLYEdge(myply.PLY(None, None, None))
+            for label in p.edge_labels:
+                e.combine(plys_by_im_line[label])
+
+            d = np.argmax(np.abs(np.dot(e.edges[0].direction(), basis_directions.transpose())))
+            direction = basis_directions[d]
+            fname = "complex_{}.ply".format(count)
+            e.write(os.path.join(args.project_directory, "wireframe_ply", fname))
+            e.combine_edges_with_direction(direction)
+            e.remove_all_vertices()
+            combined.combine(e)
+            fname = "simplified_{}.ply".format(count)
+            count += 1
+            print("Showing matches for {}".format(fname))
+            e.write(os.path.join(args.project_directory, "wireframe_ply", fname))
+            matches.append(Match(e, p.edge_labels))
+            if args.plot1:
+                matches[-1].plot_matches(args.project_directory, all_initial_lines,
+                                         renderer=renderer, name="match_{}".format(count - 1))
+
+        combined.write(os.path.join(args.project_directory, "wireframe_simplified.ply"))
+
+        # Each match stores the edge e and the labels (imnum, imname) for that edge in each image
+        # Adjacencies goes from index in matches -> list of groups of matches
+        # group matches all correspond to a single intersection point
+        adjacencies = {}
+        # Each image's graph is built once and shared by every match labelled in that image
+        graphs = wireframe.WireframeGraphSet(record_dict, threshold=w_args.score_thresh,
+                                             vertices=args.graph_vertices, snap_radius=args.snap_radius)
+        # Lookup (imnum, linenum) label -> indices of matches containing it
+        matches_by_label = {}
+        for ei, m in enumerate(matches):
+            for label in m.labels:
+                matches_by_label.setdefault(label, []).append(ei)
+
+        for ei, m in enumerate(matches):
+            print('Processing {}th match'.format(ei))
+            # Find all other matches incident with this one
+            adjacencies[ei] = []
+            for imnum, linenum in m.labels:
+                g = graphs[imnum]
+                intersecting_linenums = g.get_intersecting_lines(linenum)
+                for group in intersecting_linenums:
+                    group_matches = []
+                    if args.plot2:
+                        g.plot_graph(g.g, all_images[imnum], highlight=group + [linenum], renderer=renderer,
+                                     filename="group_{}_{}_{}.png".format(ei, imnum, len(adjacencies[ei])))
+                    for other_linenum in group:
+                        label = (imnum, other_linenum)
+                        group_matches += matches_by_label.get(label, [])
+                    adjacencies[ei].append(group_matches)
+    finally:
+        # Waits for queued figures and stops the workers even if a step above fails
+        if renderer is not None:
+            renderer.close()
 
     # With adjacencies add a vertex that is the closest intersection point for all the adjacent edges
     count = 0
@@ -206,6 +207,13 @@ if __name__ == "__main__":
     parser.add_argument('--min_group', type=int, default=3, help="Minimum number of distance based matches for inclusion")
     parser.add_argument('--plot1', action='store_true', help="Plot matches")
     parser.add_argument('--plot2', action='store_true', help="Plot groups")
+    parser.add_argument('--headless', action='store_true', help="Write plots to wireframe_plots as PNGs instead of showing them")
+    parser.add_argument('--render_procs', type=int, default=2, help="Number of processes rendering plots in headless mode")
+    parser.add_argument('--use_store', action='store_true', help="Load records from the consolidated memory-mapped record store")
+    parser.add_argument('--graph_vertices', type=str, default='grid', choices=['grid', 'juncs', 'endpoints'],
+                        help="How line endpoints are merged into graph vertices")
+    parser.add_argument('--snap_radius', type=float, default=4.0, help="Endpoint snapping distance in pixels for juncs and endpoints vertices")
+    parser.add_argument('--ply_procs', type=int, default=1, help="Number of worker processes building shot point clouds")
     parser.add_argument('--device', type=str, default='', help="GPU Devices")
     args = parser.parse_args()
     main(args)
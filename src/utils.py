@@ -1,4 +1,3 @@
-import cv2
 import numpy as np
 
 # For portable filepath operations
@@ -25,6 +24,8 @@ def load_image(img_name, grayscale=False):
     Given the name of an image in the data directory, load and return that image.
     Image will have data type char8 ranging from 0 to 255
     """
+    import cv2
+
     flags = cv2.IMREAD_COLOR
     if grayscale:
         flags = cv2.IMREAD_GRAYSCALE
@@ -1,11 +1,31 @@
+import importlib
+
 from wireframe.ransac import RANSAC
 from wireframe.wireframe_ransac import Line3DRANSAC
 
 from wireframe.wireframe_error import WireframeError
+from wireframe.point_store import PointStore
 from wireframe.wireframe_record import WireframeRecord
-from wireframe.wireframe_graph import WireframeGraph
+from wireframe.wireframe_render import WireframeRenderer
+
+# Classes with heavy dependencies are imported the first time they are used:
+# WireframeGraph and WireframeGraphSet need igraph, Wireframe needs torch and skimage,
+# WireframePointCloud needs cv2 to project points.
+_LAZY_CLASSES = {
+    "WireframeGraph": "wireframe.wireframe_graph",
+    "WireframeGraphSet": "wireframe.wireframe_graph",
+    "Wireframe": "wireframe.wireframe",
+    "WireframePointCloud": "wireframe.wireframe_point_cloud",
+}
+
+def __getattr__(name):
+    if name in _LAZY_CLASSES:
+        value = getattr(importlib.import_module(_LAZY_CLASSES[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError("module 'wireframe' has no attribute '{}'".format(name))
 
-from wireframe.wireframe import Wireframe
-from wireframe.wireframe_point_cloud import WireframePointCloud
+def __dir__():
+    return sorted(list(globals().keys()) + list(_LAZY_CLASSES.keys()))
 
 import wireframe.project
@@ -0,0 +1,107 @@
+#
+# point_index.py
+#
+# Declares the PointIndex class, a uniform grid spatial index over 2D points
+#
+
+import numpy as np
+
+from wireframe.segment_index import segment_cells
+
+class PointIndex():
+    """
+    PointIndex
+
+    A uniform grid over 2D points covering the box [lo, hi]. Points are sorted by cell, so
+    the points of a cell are a contiguous slice. Points outside the box or with non finite
+    coordinates are not indexed.
+
+    Attributes:
+    cell -- cell size
+    origin -- lower corner of the grid
+    shape -- number of cells along each axis
+    num_points -- number of points given, indexed or not
+    """
+    def __init__(self, points, lo, hi, cell):
+        """
+        Arguments:
+        points -- numpy array [num_points, 2], or any shape with 2D points in the last axis
+        lo, hi -- corners of the indexed box
+        cell -- cell size
+        """
+        points = np.asarray(points, dtype=np.float64).reshape((-1, 2))
+        self.cell = float(cell)
+        self.origin = np.asarray(lo, dtype=np.float64)
+        self.shape = np.maximum(np.ceil((np.asarray(hi) - self.origin) / self.cell).astype(int), 1)
+        self.num_points = len(points)
+
+        with np.errstate(invalid="ignore"):
+            rel = np.floor((points - self.origin) / self.cell)
+            inside = np.all(np.isfinite(rel) & (rel >= 0) & (rel < self.shape), axis=1)
+        idx = np.nonzero(inside)[0]
+        cells = rel[idx, 0].astype(np.int64) * self.shape[1] + rel[idx, 1].astype(np.int64)
+        # Stable sort keeps points in ascending order within each cell
+        order = np.argsort(cells, kind="stable")
+        self._point_of = idx[order]
+        self._cell_start = np.searchsorted(cells[order], np.arange(self.shape[0] * self.shape[1] + 1))
+
+    @staticmethod
+    def around_segments(points, segments, radius, cell=None):
+        """
+        Returns a PointIndex covering every point within radius of the segments
+
+        Arguments:
+        points -- numpy array [num_points, 2], or any shape with 2D points in the last axis
+        segments -- numpy array [num_segments, 2, 2]
+        radius -- search radius later passed to candidates
+        cell -- (optional) cell size (default radius)
+        """
+        cell = radius if cell is None else cell
+        segments = np.asarray(segments, dtype=np.float64).reshape((-1, 2, 2))
+        if len(segments) == 0:
+            return PointIndex(points, np.zeros(2), np.zeros(2), cell)
+        # One cell of margin so rounding at the border never drops a point
+        margin = radius + cell
+        ends = segments.reshape((-1, 2))
+        return PointIndex(points, ends.min(axis=0) - margin, ends.max(axis=0) + margin, cell)
+
+    def candidates(self, segments, radius):
+        """
+        Returns the indexed points in grid cells within radius of each segment. Every
+        indexed point within radius of a segment is included, others may be.
+
+        Arguments:
+        segments -- numpy array [num_segments, 2, 2]
+        radius -- search radius
+
+        Returns:
+        offsets -- int numpy array [num_segments + 1], segment i has candidates
+            indices[offsets[i]:offsets[i + 1]]
+        indices -- int numpy array [num_candidates] of point indices, ascending per segment
+        """
+        segments = np.asarray(segments, dtype=np.float64).reshape((-1, 2, 2))
+        num_segments = len(segments)
+        seg, cells = segment_cells(segments - self.origin, self.cell, self.shape)
+
+        # A point within radius of a segment is at most k cells away from a cell the segment passes through
+        k = int(np.ceil(radius / self.cell))
+        steps = np.arange(-k, k + 1)
+        d0, d1 = np.meshgrid(steps, steps, indexing="ij")
+        c0 = (cells // self.shape[1])[:, None] + d0.reshape(-1)
+        c1 = (cells % self.shape[1])[:, None] + d1.reshape(-1)
+        valid = (c0 >= 0) & (c0 < self.shape[0]) & (c1 >= 0) & (c1 < self.shape[1])
+        num_cells = self.shape[0] * self.shape[1]
+        keys = np.unique(np.repeat(seg, valid.sum(axis=1)).astype(np.int64) * num_cells
+                         + (c0 * self.shape[1] + c1)[valid])
+        seg = keys // num_cells
+        cells = keys % num_cells
+
+        # Expand each (segment, cell) pair to the points in the cell
+        starts = self._cell_start[cells]
+        counts = self._cell_start[cells + 1] - starts
+        pos = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(starts, counts)
+        seg = np.repeat(seg, counts)
+        points = self._point_of[pos]
+        order = np.lexsort((points, seg))
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(seg, minlength=num_segments))])
+        return offsets, points[order]
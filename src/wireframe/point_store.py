@@ -0,0 +1,125 @@
+#
+# point_store.py
+#
+# Declares the PointStore class, one read only array holding the points of every shot
+#
+
+import json
+import os
+
+import numpy as np
+
+POINTS_FILE = "points.npy"
+SHOTS_FILE = "shots.json"
+
+class PointStore():
+    """
+    PointStore
+
+    Holds the points of many shots concatenated in one read only array, so point clouds
+    can be stored as index arrays into it and only gathered when coordinates are needed.
+
+    Attributes:
+    points -- read only numpy array [num_points, 3]
+    imnames -- shot names, in storage order
+    directory -- directory the points are memory mapped from, or None if held in memory
+
+    A store saved with save is memory mapped, and pickling it only sends its directory,
+    so worker processes can share the points without copying them.
+    """
+    def __init__(self, points, offsets, imnames, directory=None):
+        """
+        Arguments:
+        points -- numpy array [num_points, 3]
+        offsets -- int numpy array [num_shots + 1], shot i has points[offsets[i]:offsets[i + 1]]
+        imnames -- shot names
+        """
+        self.points = np.asarray(points, dtype=np.float64).reshape((-1, 3))
+        if self.points.flags.writeable:
+            self.points.flags.writeable = False
+        self.directory = directory
+        self._offsets = np.asarray(offsets, dtype=int)
+        self.imnames = list(imnames)
+        self._rows = {imname: i for i, imname in enumerate(self.imnames)}
+
+    @staticmethod
+    def from_shots(shots):
+        """
+        Builds a store from OpenSfM shot information
+
+        Arguments:
+        shots -- dict from imname -> shot information with a "vertices" list
+        """
+        imnames = list(shots.keys())
+        arrays = [np.array(shots[imname]["vertices"], dtype=np.float64).reshape((-1, 3)) for imname in imnames]
+        offsets = np.concatenate([[0], np.cumsum([len(a) for a in arrays], dtype=int)])
+        points = np.concatenate(arrays) if arrays else np.zeros((0, 3))
+        return PointStore(points, offsets, imnames)
+
+    def save(self, directory):
+        """
+        Writes the store to directory
+
+        Arguments:
+        directory -- directory to write to, created if missing
+
+        Returns:
+        store -- PointStore memory mapped from directory
+        """
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, POINTS_FILE), self.points)
+        with open(os.path.join(directory, SHOTS_FILE), 'w') as f:
+            json.dump({"imnames": self.imnames, "offsets": self._offsets.tolist()}, f)
+        return PointStore.load(directory)
+
+    @staticmethod
+    def load(directory):
+        """
+        Returns a read only PointStore memory mapped from a directory written by save
+        """
+        points = np.load(os.path.join(directory, POINTS_FILE), mmap_mode='r')
+        with open(os.path.join(directory, SHOTS_FILE), 'r') as f:
+            shots = json.load(f)
+        return PointStore(points, shots["offsets"], shots["imnames"], directory=directory)
+
+    def __getstate__(self):
+        if self.directory is not None:
+            return {"directory": self.directory}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if "points" not in state:
+            state = PointStore.load(state["directory"]).__dict__
+        self.__dict__.update(state)
+
+    def __len__(self):
+        return len(self.points)
+
+    def __contains__(self, imname):
+        return imname in self._rows
+
+    def shot_range(self, imname):
+        """
+        Returns the (start, end) indices of a shot's points in the store
+        """
+        i = self._rows[imname]
+        return int(self._offsets[i]), int(self._offsets[i + 1])
+
+    def shot_points(self, imname):
+        """
+        Returns a read only view of a shot's points
+        """
+        start, end = self.shot_range(imname)
+        return self.points[start:end]
+
+    def gather(self, indices):
+        """
+        Returns a copy of the points at indices
+
+        Arguments:
+        indices -- int numpy array of store indices
+
+        Returns:
+        points -- numpy array [len(indices), 3]
+        """
+        return self.points[indices]
@@ -5,11 +5,21 @@
 #
 
 import wireframe.wireframe_record
+import wireframe.wireframe_record_store
 import numpy as np
+import concurrent.futures
+import hashlib
+import json
+import multiprocessing
 import os
+import queue
+import threading
 
 DIR_IMAGES = "images"
 DIR_RECS = "wireframe_recs"
+DIR_STORE = "wireframe_store"
+MANIFEST = "manifest.json"
+MODEL_KEY = "model_key.json"
 
 def setup_project_data(proj_dir):
     images = os.listdir(os.path.join(proj_dir, DIR_IMAGES))
@@ -17,42 +27,455 @@ def setup_project_data(proj_dir):
         reconstruction = json.load(f)
     return images, reconstruction
 
-def save_wireframe_records(proj_dir, w):
-    num_images = 0
-    for imname in os.listdir(os.path.join(proj_dir, DIR_IMAGES)):
-        if imname.endswith(".png") or filename.endswith(".jpg"):
-            print("Parsing {}...".format(imname))
-            rec = w.parse(os.path.join(proj_dir, DIR_IMAGES, imname))
-            rec.save(os.path.join(proj_dir, DIR_RECS, "{}.rec".format(imname)))
-            num_images += 1
-    print("Saved {} wireframe records.".format(num_images))
+def list_project_images(proj_dir):
+    """
+    Returns the sorted list of image filenames in the project images directory
+    """
+    return [imname for imname in sorted(os.listdir(os.path.join(proj_dir, DIR_IMAGES)))
+            if imname.endswith(".png") or imname.endswith(".jpg")]
+
+def record_filename(proj_dir, imname):
+    """
+    Returns the record filename (without the .npz extension) for an image
+    """
+    return os.path.join(proj_dir, DIR_RECS, "{}.rec".format(imname))
+
+def save_wireframe_records(proj_dir, w, num_procs=1, model_key=None, **kwargs):
+    imnames = list_project_images(proj_dir)
+    if num_procs > 1:
+        saved = shard_wireframe_records(proj_dir, w, imnames, num_procs, **kwargs)
+    else:
+        saved = list(stream_wireframe_records(proj_dir, w, imnames, **kwargs).keys())
+    if model_key is not None:
+        update_manifest(proj_dir, saved, model_key)
+    print("Saved {} wireframe records.".format(len(saved)))
 
 def load_wireframe_records(proj_dir):
     records = {}
     for fname in os.listdir(os.path.join(proj_dir, DIR_RECS)):
         if fname.endswith(".npz"):
             print("Loading {}...".format(fname))
-            rec = wireframe.WireframeRecord.load(os.path.join(proj_dir, DIR_RECS, fname))
+            rec = wireframe.wireframe_record.WireframeRecord.load(os.path.join(proj_dir, DIR_RECS, fname))
             records[fname[:-8]] = rec
     print("Loaded {} wireframe records.".format(len(records)))
     return records
 
-def generate_wireframe_records(proj_dir, w, force=False):
+def load_wireframe_record_store(proj_dir):
+    """
+    Returns the project's WireframeRecordStore, or None if it has not been written
+    """
+    directory = os.path.join(proj_dir, DIR_STORE)
+    if not wireframe.wireframe_record_store.WireframeRecordStore.exists(directory):
+        return None
+    return wireframe.wireframe_record_store.WireframeRecordStore(directory)
+
+def save_wireframe_record_store(proj_dir, records, sources=None):
+    """
+    Consolidates the records into the project's memory-mapped WireframeRecordStore
+
+    Arguments:
+    proj_dir -- project directory
+    records -- dict from imname -> WireframeRecord
+    sources -- (optional) dict from imname -> record_source of each record
+
+    Returns:
+    store -- the written WireframeRecordStore
+    """
+    return wireframe.wireframe_record_store.WireframeRecordStore.write(os.path.join(proj_dir, DIR_STORE), records,
+                                                                       sources)
+
+def record_source(proj_dir, imname, manifest=None):
+    """
+    Returns a description of the record file of an image and its manifest entry.
+    A store row is current only if its source still equals this, so records rewritten
+    by any path (or with a changed manifest entry) are never served from a stale store.
+    """
+    stat = os.stat(record_filename(proj_dir, imname) + ".npz")
+    entry = manifest.get(imname) if manifest is not None else None
+    return {"record": [stat.st_size, stat.st_mtime_ns], "manifest": entry}
+
+def generate_wireframe_records(proj_dir, w, force=False, num_procs=1, use_store=False, model_key=None,
+                               to_generate=None, **kwargs):
+    """
+    Loads the wireframe records for all project images, generating any that are missing.
+
+    Arguments:
+    proj_dir -- project directory
+    w -- a Wireframe instance. Must be setup unless num_procs > 1.
+        May be None if no records need generating (see missing_wireframe_records)
+    force -- regenerate every record even if it exists (default False)
+    num_procs -- number of worker processes to shard generation across (default 1)
+    use_store -- load records from the project's WireframeRecordStore when its rows match the
+        current record files and manifest, and rewrite the store otherwise (default False)
+    model_key -- (optional) key of the config and checkpoint from model_key. If given, a
+        manifest of the source image and model of every record is kept, and only new or
+        changed images (or all images after a model change) are regenerated
+    to_generate -- (optional) images to generate, as returned by missing_wireframe_records
+        with the same force and model_key. Computed if None
+
+    Optional keyword arguments are passed to shard_wireframe_records (e.g. use_cache)
+    and stream_wireframe_records.
+
+    Returns:
+    records -- dict from imname -> WireframeRecord
+    """
     records = {}
-    for imname in os.listdir(os.path.join(proj_dir, DIR_IMAGES)):
-        if imname.endswith(".png") or filename.endswith(".jpg"):
-            if force or not os.path.isfile(os.path.join(proj_dir, DIR_RECS, "{}.rec.npz".format(imname))):
-                print("Generating rec for {}".format(imname))
-                rec = w.parse(os.path.join(proj_dir, DIR_IMAGES, imname))
-                rec.save(os.path.join(proj_dir, DIR_RECS, "{}.rec".format(imname)))
-                records[imname] = rec
-            else:
-                print("Loading rec for {}".format(imname))
-                rec = wireframe.wireframe_record.WireframeRecord.load(os.path.join(proj_dir, DIR_RECS, "{}.rec.npz".format(imname)))
-                records[imname] = rec
+    manifest = load_manifest(proj_dir) if model_key is not None else None
+    if to_generate is None:
+        to_generate = missing_wireframe_records(proj_dir, force=force, model_key=model_key, manifest=manifest)
+    store = load_wireframe_record_store(proj_dir) if use_store and not force else None
+    # dict from imname -> record_source, compared against the store rows
+    sources = {}
+    skip = set(to_generate)
+    for imname in list_project_images(proj_dir):
+        if imname in skip:
+            continue
+        if use_store:
+            sources[imname] = record_source(proj_dir, imname, manifest)
+        if store is not None and store.sources.get(imname) == sources[imname]:
+            records[imname] = store.get(imname)
+        else:
+            print("Loading rec for {}".format(imname))
+            records[imname] = wireframe.wireframe_record.WireframeRecord.load(record_filename(proj_dir, imname) + ".npz")
+    if num_procs > 1:
+        for imname in shard_wireframe_records(proj_dir, w, to_generate, num_procs, **kwargs):
+            records[imname] = wireframe.wireframe_record.WireframeRecord.load(record_filename(proj_dir, imname) + ".npz")
+    else:
+        records.update(stream_wireframe_records(proj_dir, w, to_generate, **kwargs))
+    if model_key is not None and len(to_generate) > 0:
+        manifest = update_manifest(proj_dir, to_generate, model_key)
+    if use_store:
+        for imname in to_generate:
+            sources[imname] = record_source(proj_dir, imname, manifest)
+    if use_store and (store is None or store.sources != sources):
+        print("Writing wireframe record store")
+        records = save_wireframe_record_store(proj_dir, records, sources).records()
     print("Got {} wireframe records".format(len(records)))
     return records
 
+def missing_wireframe_records(proj_dir, force=False, model_key=None, manifest=None):
+    """
+    Returns the list of project images that need their wireframe record (re)generated
+
+    Arguments:
+    proj_dir -- project directory
+    force -- treat every record as missing (default False)
+    model_key -- (optional) key of the config and checkpoint from model_key. If given,
+        records are also stale when the manifest shows they were generated from a
+        different image or model
+    manifest -- (optional) already loaded manifest, loaded if None and model_key is given
+    """
+    if manifest is None and model_key is not None:
+        manifest = load_manifest(proj_dir)
+    missing = []
+    for imname in list_project_images(proj_dir):
+        if force or not os.path.isfile(record_filename(proj_dir, imname) + ".npz"):
+            missing.append(imname)
+        elif manifest is not None and not manifest_entry_valid(proj_dir, imname, manifest.get(imname), model_key):
+            print("Record for {} is stale".format(imname))
+            missing.append(imname)
+    return missing
+
+def stream_wireframe_records(proj_dir, w, imnames, **kwargs):
+    """
+    Generates and saves wireframe records for the given images.
+
+    Decoding, model inference and record writing run as a pipeline: a thread pool
+    decodes and resizes images ahead of the model, the model consumes batches from
+    a bounded queue, and a writer thread compresses and saves finished records.
+
+    Arguments:
+    proj_dir -- project directory
+    w -- a setup Wireframe instance
+    imnames -- list of image filenames in the project images directory
+
+    Optional keyword arguments:
+    batch_size -- number of images per model evaluation (default 1)
+    decode_workers -- number of threads decoding images (default 4)
+    decode_queue -- max number of decoded images waiting for the model (default 8)
+    write_queue -- max number of records waiting to be saved (default 16)
+    save_postprocessed -- deduplicate lines in the writer thread and save them in the record (default False)
+
+    Returns:
+    records -- dict from imname -> WireframeRecord
+    """
+    batch_size = kwargs.get("batch_size", 1)
+    decode_workers = kwargs.get("decode_workers", 4)
+    decode_queue = queue.Queue(maxsize=kwargs.get("decode_queue", 8))
+    write_queue = queue.Queue(maxsize=kwargs.get("write_queue", 16))
+    save_postprocessed = kwargs.get("save_postprocessed", False)
+    records = {}
+    if len(imnames) == 0:
+        return records
+
+    def decode(imname):
+        im = w.load_image(os.path.join(proj_dir, DIR_IMAGES, imname))
+        return w.preprocess_image(im), im.shape
+
+    errors = []
+    # Set when the consumer stops early, e.g. because an image failed to decode
+    stop = threading.Event()
+
+    def put_unless_stopped(item):
+        while not stop.is_set():
+            try:
+                decode_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce(executor):
+        # Submitting blocks once decode_queue is full, bounding how far decoding runs ahead
+        for imname in imnames:
+            if stop.is_set() or not put_unless_stopped((imname, executor.submit(decode, imname))):
+                return
+        put_unless_stopped(None)
+
+    def write():
+        while True:
+            item = write_queue.get()
+            if item is None:
+                break
+            imname, rec = item
+            try:
+                rec.save(record_filename(proj_dir, imname), postprocessed=save_postprocessed)
+            except Exception as e:
+                errors.append(e)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=decode_workers) as executor:
+        producer = threading.Thread(target=produce, args=(executor,), daemon=True)
+        writer = threading.Thread(target=write, daemon=True)
+        producer.start()
+        writer.start()
+
+        try:
+            done = False
+            while not done:
+                batch = []
+                while len(batch) < batch_size:
+                    item = decode_queue.get()
+                    if item is None:
+                        done = True
+                        break
+                    batch.append(item)
+                if len(batch) == 0:
+                    break
+
+                names = [imname for imname, _ in batch]
+                decoded = [future.result() for _, future in batch]
+                print("Generating rec for {}".format(", ".join(names)))
+                recs = w.infer(np.stack([image for image, _ in decoded]),
+                               [imshape for _, imshape in decoded],
+                               [imnum_from_imname(imname) for imname in names])
+                for imname, rec in zip(names, recs):
+                    records[imname] = rec
+                    write_queue.put((imname, rec))
+        finally:
+            # Always let the writer save the records already queued, even if a batch failed.
+            # The producer is stopped while the executor is still running so it never submits after shutdown.
+            stop.set()
+            producer.join()
+            write_queue.put(None)
+            writer.join()
+
+    if errors:
+        raise errors[0]
+    return records
+
+def shard_wireframe_records(proj_dir, w, imnames, num_procs, use_cache=False, **kwargs):
+    """
+    Generates and saves wireframe records by splitting the images across worker processes.
+
+    Each worker sets up its own copy of the Wireframe model once, limited to an even
+    share of the available cores, and streams its shard with stream_wireframe_records.
+    Records are written to the usual wireframe_recs/ layout.
+
+    Arguments:
+    proj_dir -- project directory
+    w -- a Wireframe instance (does not need to be setup)
+    imnames -- list of image filenames in the project images directory
+    num_procs -- number of worker processes
+    use_cache -- workers load the model from the TorchScript cache (see Wireframe.setup) (default False)
+
+    Optional keyword arguments are passed to stream_wireframe_records.
+
+    Returns:
+    imnames -- list of image filenames whose records were saved
+    """
+    num_procs = max(1, min(num_procs, len(imnames)))
+    if len(imnames) == 0:
+        return []
+    num_threads = max(1, (os.cpu_count() or 1) // num_procs)
+    shards = [imnames[i::num_procs] for i in range(num_procs)]
+
+    saved = []
+    # spawn rather than fork so each worker gets a clean torch threading state
+    ctx = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_procs, mp_context=ctx) as executor:
+        futures = [executor.submit(_generate_shard, proj_dir, w.copy(num_threads=num_threads), shard, use_cache, kwargs)
+                   for shard in shards]
+        for future in futures:
+            saved += future.result()
+    return saved
+
+def _generate_shard(proj_dir, w, imnames, use_cache, kwargs):
+    if not w.setup(use_cache=use_cache):
+        raise w.error
+    return list(stream_wireframe_records(proj_dir, w, imnames, **kwargs).keys())
+
+def build_wireframe_point_clouds(proj_dir, records, shots, cameras, point_store, num_procs=1, **kwargs):
+    """
+    Builds and writes the WireframePointCloud of every shot, optionally across worker processes.
+
+    With several processes the point store is saved to a temporary directory next to the
+    PLY output and memory mapped by every worker, so shot points are never copied between
+    processes. Shot information is sent without its vertices.
+
+    Arguments:
+    proj_dir -- project directory
+    records -- dict from imname -> WireframeRecord
+    shots -- dict from imname -> OpenSfM shot information
+    cameras -- OpenSfM camera information
+    point_store -- PointStore with the points of every shot
+    num_procs -- number of worker processes (default 1)
+
+    Optional keyword arguments are passed to WireframePointCloud.
+
+    Returns:
+    wpcs -- list of WireframePointCloud in the order of shots, sharing point_store
+    """
+    import tempfile
+
+    imnames = list(shots.keys())
+    num_procs = max(1, min(num_procs, len(imnames)))
+    if num_procs <= 1:
+        return [_build_point_cloud(proj_dir, imname, records[imname], shots[imname], cameras, point_store, kwargs)
+                for imname in imnames]
+
+    ply_dir = os.path.join(proj_dir, "wireframe_ply")
+    os.makedirs(ply_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=ply_dir) as store_dir:
+        shared_store = point_store.save(store_dir)
+        ctx = multiprocessing.get_context("spawn")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_procs, mp_context=ctx) as executor:
+            futures = []
+            for imname in imnames:
+                iminfo = {k: v for k, v in shots[imname].items() if k != "vertices"}
+                futures.append(executor.submit(_build_point_cloud, proj_dir, imname, records[imname], iminfo,
+                                               cameras, shared_store, kwargs))
+            # Results are collected in submission order
+            wpcs = [future.result() for future in futures]
+        # Release the memory maps before the temporary directory is removed
+        for wpc in wpcs:
+            wpc.attach_store(point_store)
+    return wpcs
+
+def _build_point_cloud(proj_dir, imname, rec, iminfo, cameras, point_store, kwargs):
+    import wireframe.wireframe_point_cloud
+
+    print("Processing {}...".format(imname))
+    wpc = wireframe.wireframe_point_cloud.WireframePointCloud(proj_dir, imname, rec, iminfo, cameras,
+                                                              point_store=point_store, **kwargs)
+    wpc.write_line_point_clouds()
+    return wpc
+
+def file_hash(filenames, chunk_size=1 << 20):
+    """
+    Returns a hex digest of the contents of all the files
+    """
+    h = hashlib.sha1()
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+def model_key(config_file, model_file, proj_dir=None):
+    """
+    Returns a key identifying the model by the contents of its config and checkpoint
+
+    Arguments:
+    config_file -- LCNN yaml configuration file
+    model_file -- LCNN checkpoint file
+    proj_dir -- (optional) project directory to cache the key in. The files are only
+        hashed again if their size or modification time changed
+    """
+    files = []
+    for filename in [config_file, model_file]:
+        stat = os.stat(filename)
+        files.append([os.path.abspath(filename), stat.st_size, stat.st_mtime_ns])
+    cache = os.path.join(proj_dir, DIR_RECS, MODEL_KEY) if proj_dir is not None else None
+    if cache is not None and os.path.isfile(cache):
+        with open(cache, 'r') as f:
+            cached = json.load(f)
+        if cached.get("files") == files:
+            return cached["key"]
+
+    key = file_hash([config_file, model_file])
+    if cache is not None:
+        os.makedirs(os.path.dirname(cache), exist_ok=True)
+        with open(cache + ".tmp", 'w') as f:
+            json.dump({"files": files, "key": key}, f)
+        os.replace(cache + ".tmp", cache)
+    return key
+
+def load_manifest(proj_dir):
+    """
+    Returns the record manifest: a dict from imname -> entry describing the source
+    image and model each record was generated from
+    """
+    filename = os.path.join(proj_dir, DIR_RECS, MANIFEST)
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+def manifest_entry(proj_dir, imname, model_key):
+    """
+    Returns the manifest entry for a record generated now from the image and model
+    """
+    path = os.path.join(proj_dir, DIR_IMAGES, imname)
+    stat = os.stat(path)
+    return {"image": file_hash([path]), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "model": model_key}
+
+def manifest_entry_valid(proj_dir, imname, entry, model_key):
+    """
+    Returns True if the record described by entry matches the current image and model.
+    The image is only hashed if its size or modification time changed.
+    """
+    if entry is None or entry.get("model") != model_key:
+        return False
+    stat = os.stat(os.path.join(proj_dir, DIR_IMAGES, imname))
+    if stat.st_size == entry.get("size") and stat.st_mtime_ns == entry.get("mtime_ns"):
+        return True
+    return file_hash([os.path.join(proj_dir, DIR_IMAGES, imname)]) == entry.get("image")
+
+def update_manifest(proj_dir, imnames, model_key, num_workers=4):
+    """
+    Records that the images' records were generated from their current contents and the model
+
+    Arguments:
+    proj_dir -- project directory
+    imnames -- list of image filenames whose records were just generated
+    model_key -- key of the config and checkpoint from model_key
+    num_workers -- number of threads hashing images (default 4)
+
+    Returns:
+    manifest -- the updated manifest
+    """
+    manifest = load_manifest(proj_dir)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        entries = executor.map(lambda imname: manifest_entry(proj_dir, imname, model_key), imnames)
+        for imname, entry in zip(imnames, entries):
+            manifest[imname] = entry
+    filename = os.path.join(proj_dir, DIR_RECS, MANIFEST)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename + ".tmp", 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(filename + ".tmp", filename)
+    return manifest
+
 def imnum_from_imname(imname):
     start = -1
     end = -1
@@ -0,0 +1,236 @@
+#
+# segment_index.py
+#
+# Declares the SegmentIndex class, a uniform grid spatial index over 2D line segments
+#
+
+import numpy as np
+
+class SegmentIndex():
+    """
+    SegmentIndex
+
+    A uniform grid over 2D segments. Each segment is registered in every cell it passes
+    through, stored as a sorted (cell -> segment indices) table, so queries only look at
+    segments in the cells they touch before running exact vectorized tests.
+
+    Coordinates can be in any consistent order, e.g. the (y, x) pixel coordinates of
+    WireframeRecord.postprocess.
+
+    Attributes:
+    segments -- numpy array [num_segments, 2, 2]
+    cell -- cell size
+    shape -- number of cells along each axis
+    """
+    def __init__(self, segments, extent, cell=None, cells_per_side=32):
+        """
+        Arguments:
+        segments -- numpy array [num_segments, 2, 2] of (start, end) points
+        extent -- size of the indexed area along each axis, e.g. the image shape.
+            Segments outside [0, extent] are clamped to the border cells
+        cell -- (optional) cell size. Defaults to max(extent) / cells_per_side
+        cells_per_side -- number of cells along the longer axis if cell is None (default 32)
+        """
+        self.segments = np.asarray(segments, dtype=np.float64).reshape(-1, 2, 2)
+        extent = np.asarray(extent[:2], dtype=np.float64)
+        self.cell = float(cell) if cell is not None else max(float(extent.max()) / cells_per_side, 1e-9)
+        self.shape = np.maximum(np.ceil(extent / self.cell).astype(int), 1)
+        self._build()
+
+    def __len__(self):
+        return len(self.segments)
+
+    def _build(self):
+        n = len(self.segments)
+        seg, cells = segment_cells(self.segments, self.cell, self.shape)
+        # Remove duplicates from clamped segments, then sort by cell
+        keys = np.unique(cells.astype(np.int64) * max(n, 1) + seg)
+        self._cell_of = keys // max(n, 1)
+        self._seg_of = keys % max(n, 1)
+        self._cell_start = np.searchsorted(self._cell_of, np.arange(self.shape[0] * self.shape[1] + 1))
+
+    def _clamp(self, cells, axis):
+        return np.clip(cells, 0, self.shape[axis] - 1).astype(int)
+
+    def _cell_range(self, lo, hi):
+        lo = np.asarray(lo, dtype=np.float64) / self.cell
+        hi = np.asarray(hi, dtype=np.float64) / self.cell
+        return (self._clamp(np.floor(lo[0]), 0), self._clamp(np.floor(hi[0]), 0),
+                self._clamp(np.floor(lo[1]), 1), self._clamp(np.floor(hi[1]), 1))
+
+    def _limit(self, idx, limit):
+        if limit is not None:
+            idx = idx[idx < limit]
+        return idx
+
+    def candidates(self, lo, hi, limit=None):
+        """
+        Returns the sorted indices of segments in cells overlapping the box [lo, hi].
+        Every segment that intersects the box is included, others may be.
+
+        Arguments:
+        lo, hi -- corners of the box
+        limit -- (optional) only consider the first limit segments, e.g. the lines above
+            a score threshold from WireframeRecord.num_above
+        """
+        i0, i1, j0, j1 = self._cell_range(lo, hi)
+        cols = np.arange(i0, i1 + 1)
+        starts = self._cell_start[cols * self.shape[1] + j0]
+        ends = self._cell_start[cols * self.shape[1] + j1 + 1]
+        found = [self._seg_of[s:e] for s, e in zip(starts, ends)]
+        if len(found) == 0:
+            return np.zeros(0, dtype=int)
+        return self._limit(np.unique(np.concatenate(found)), limit)
+
+    def near_point(self, point, r, limit=None):
+        """
+        Returns the sorted indices of segments within distance r of point
+
+        Arguments:
+        point -- numpy array [2]
+        r -- search radius
+        limit -- (optional) only consider the first limit segments
+        """
+        point = np.asarray(point, dtype=np.float64)
+        idx = self.candidates(point - r, point + r, limit)
+        return idx[point_segment_distance(point, self.segments[idx]) <= r]
+
+    def in_box(self, lo, hi, limit=None):
+        """
+        Returns the sorted indices of segments that cross or lie inside the box [lo, hi]
+
+        Arguments:
+        lo, hi -- corners of the box
+        limit -- (optional) only consider the first limit segments
+        """
+        lo = np.asarray(lo, dtype=np.float64)
+        hi = np.asarray(hi, dtype=np.float64)
+        idx = self.candidates(lo, hi, limit)
+        return idx[segments_intersect_box(self.segments[idx], lo, hi)]
+
+    def candidate_pairs(self, limit=None):
+        """
+        Returns the pairs of segments that share a cell. Every pair of intersecting
+        segments is included.
+
+        Arguments:
+        limit -- (optional) only consider the first limit segments
+
+        Returns:
+        pairs -- int numpy array [num_pairs, 2] with pairs[:, 0] < pairs[:, 1], sorted
+        """
+        seg = self._seg_of
+        cell = self._cell_of
+        if limit is not None:
+            keep = seg < limit
+            seg, cell = seg[keep], cell[keep]
+        # All pairs within each cell: entries are sorted by cell, so for each entry pair
+        # it with the following entries of the same cell
+        counts = np.bincount(cell, minlength=self.shape[0] * self.shape[1])
+        cell_end = np.cumsum(counts)[cell]
+        num_after = cell_end - np.arange(len(seg)) - 1
+        first = np.repeat(np.arange(len(seg)), num_after)
+        second = np.arange(len(first)) - np.repeat(np.cumsum(num_after) - num_after, num_after) + first + 1
+        if len(first) == 0:
+            return np.zeros((0, 2), dtype=int)
+        a = seg[first]
+        b = seg[second]
+        n = max(len(self.segments), 1)
+        keys = np.unique(np.minimum(a, b).astype(np.int64) * n + np.maximum(a, b))
+        return np.stack([keys // n, keys % n], axis=1)
+
+###############################################################
+# Utility functions
+###############################################################
+
+def segment_cells(segments, cell, shape):
+    """
+    Returns the grid cells each segment passes through. Parts of segments outside the
+    grid are clamped to the border cells.
+
+    Arguments:
+    segments -- numpy array [num_segments, 2, 2], with the grid origin at (0, 0)
+    cell -- cell size
+    shape -- number of cells along each axis
+
+    Returns:
+    seg -- int numpy array [num_entries] of segment indices, ascending
+    cells -- int numpy array [num_entries] of flat cell numbers (axis 0 cell * shape[1] + axis 1 cell),
+        a segment may repeat a cell where it is clamped
+    """
+    def clamp(c, axis):
+        return np.clip(c, 0, shape[axis] - 1).astype(int)
+
+    n = len(segments)
+    p = segments[:, 0] / cell
+    q = segments[:, 1] / cell
+
+    # Walk each segment one column (axis 0 cell) at a time: the part of the segment
+    # inside the column spans a range of rows (axis 1 cells), giving the exact set of
+    # cells the segment passes through.
+    lo0 = np.minimum(p[:, 0], q[:, 0])
+    hi0 = np.maximum(p[:, 0], q[:, 0])
+    c0 = clamp(np.floor(lo0), 0)
+    c1 = clamp(np.floor(hi0), 0)
+    seg = np.repeat(np.arange(n), c1 - c0 + 1)
+    col = np.arange(len(seg)) - np.repeat(np.cumsum(c1 - c0 + 1) - (c1 - c0 + 1), c1 - c0 + 1) + c0[seg]
+
+    # Axis 0 interval of the segment inside the column, then the matching axis 1 range.
+    # The border columns also take the parts of the segment beyond the grid.
+    a0 = np.where(col == 0, lo0[seg], np.maximum(lo0[seg], col))
+    a1 = np.where(col == shape[0] - 1, hi0[seg], np.minimum(hi0[seg], col + 1))
+    d = q[seg] - p[seg]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t0 = np.where(d[:, 0] != 0, (a0 - p[seg, 0]) / d[:, 0], 0)
+        t1 = np.where(d[:, 0] != 0, (a1 - p[seg, 0]) / d[:, 0], 1)
+    t0 = np.clip(t0, 0, 1)
+    t1 = np.clip(t1, 0, 1)
+    y0 = p[seg, 1] + d[:, 1] * t0
+    y1 = p[seg, 1] + d[:, 1] * t1
+    r0 = clamp(np.floor(np.minimum(y0, y1)), 1)
+    r1 = clamp(np.floor(np.maximum(y0, y1)), 1)
+
+    counts = r1 - r0 + 1
+    seg2 = np.repeat(seg, counts)
+    col2 = np.repeat(col, counts)
+    row2 = np.arange(len(seg2)) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(r0, counts)
+    return seg2, col2 * shape[1] + row2
+
+def point_segment_distance(point, segments):
+    """
+    Returns the distance from point to each segment
+
+    Arguments:
+    point -- numpy array [2]
+    segments -- numpy array [num_segments, 2, 2]
+    """
+    start = segments[:, 0]
+    d = segments[:, 1] - start
+    dd = np.maximum(np.sum(d * d, axis=1), 1e-12)
+    t = np.clip(np.sum((point - start) * d, axis=1) / dd, 0, 1)
+    return np.linalg.norm(start + t[:, None] * d - point, axis=1)
+
+def segments_intersect_box(segments, lo, hi):
+    """
+    Returns a boolean mask of the segments that intersect the box [lo, hi] (Liang-Barsky clipping)
+
+    Arguments:
+    segments -- numpy array [num_segments, 2, 2]
+    lo, hi -- corners of the box
+    """
+    start = segments[:, 0]
+    d = segments[:, 1] - start
+    t0 = np.zeros(len(segments))
+    t1 = np.ones(len(segments))
+    ok = np.ones(len(segments), dtype=bool)
+    for axis in range(2):
+        parallel = d[:, axis] == 0
+        ok &= ~(parallel & ((start[:, axis] < lo[axis]) | (start[:, axis] > hi[axis])))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ta = (lo[axis] - start[:, axis]) / d[:, axis]
+            tb = (hi[axis] - start[:, axis]) / d[:, axis]
+        t_enter = np.where(parallel, 0, np.minimum(ta, tb))
+        t_exit = np.where(parallel, 1, np.maximum(ta, tb))
+        t0 = np.maximum(t0, t_enter)
+        t1 = np.minimum(t1, t_exit)
+    return ok & (t0 <= t1)
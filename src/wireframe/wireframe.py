@@ -5,16 +5,12 @@
 #
 
 import os
-import os.path as osp
 import random
 
-import matplotlib as mpl
-import matplotlib.pyplot as plt
 import numpy as np
 import skimage.io
 import skimage.transform
 import torch
-import yaml
 
 import lcnn
 from lcnn.config import C, M
@@ -23,19 +19,13 @@ from lcnn.models.multitask_learner import MultitaskHead, MultitaskLearner
 from lcnn.postprocess import postprocess
 from lcnn.utils import recursive_to
 
+import wireframe.wireframe_cache
+import wireframe.wireframe_error
 import wireframe.wireframe_record
 import wireframe.wireframe_graph
+import wireframe.wireframe_quantize
 import wireframe.project
 
-PLTOPTS = {"color": "#33FFFF", "s": 15, "edgecolors": "none", "zorder": 5}
-cmap = plt.get_cmap("jet")
-norm = mpl.colors.Normalize(vmin=0.9, vmax=1.0)
-sm = plt.cm.ScalarMappable(cmap=cmap, norm=norm)
-sm.set_array([])
-
-def c(x):
-    return sm.to_rgba(x)
-
 class Wireframe():
     """
     Wireframe class
@@ -45,10 +35,18 @@ class Wireframe():
     Depends on the lcnn package
     """
     
-    def __init__(self, config_file, model_file, gpu_devices):
+    def __init__(self, config_file, model_file, gpu_devices, num_threads=None):
+        """
+        Arguments:
+        config_file -- LCNN yaml configuration file
+        model_file -- LCNN checkpoint file
+        gpu_devices -- value for CUDA_VISIBLE_DEVICES
+        num_threads -- (optional) number of torch intra-op threads to use
+        """
         self._config_file = config_file
         self._model_file = model_file
         self._gpu_devices = gpu_devices
+        self._num_threads = num_threads
         self._device = None
         self._checkpoint = None
         self._model = None
@@ -57,10 +55,17 @@ class Wireframe():
         self.initialized = False
     
 
-    def setup(self):
+    def setup(self, quantize=None, calibration_images=None, use_cache=False):
         """
         Loads the LCNN model and parameters.
         Must be called before any processing can occur.
+
+        Arguments:
+        quantize -- (optional) "dynamic" or "static" to quantize the model to int8 for cpu inference.
+            dynamic quantizes the LineVectorizer MLP, static also quantizes the hourglass convolutions.
+        calibration_images -- list of image filenames used to calibrate static quantization
+        use_cache -- load a TorchScript export cached next to the checkpoint, creating it if missing.
+            The cache is keyed by the config and checkpoint contents. Ignored when quantizing.
         
         Returns:
          - bool resulting initialized status
@@ -75,11 +80,19 @@ class Wireframe():
             random.seed(0)
             np.random.seed(0)
             torch.manual_seed(0)
+            if self._num_threads is not None:
+                torch.set_num_threads(self._num_threads)
             
             
+            if quantize is not None and quantize not in wireframe.wireframe_quantize.QUANTIZE_MODES:
+                raise wireframe.wireframe_error.WireframeError("Unknown quantize mode {}".format(quantize))
+
             device_name = "cpu"
             os.environ["CUDA_VISIBLE_DEVICES"] = self._gpu_devices
-            if torch.cuda.is_available():
+            if quantize is not None:
+                # Quantized kernels only run on the cpu
+                print("Quantizing model ({}) for the cpu".format(quantize))
+            elif torch.cuda.is_available():
                 device_name = "cuda"
                 torch.backends.cudnn.deterministic = True
                 torch.cuda.manual_seed(0)
@@ -87,21 +100,47 @@ class Wireframe():
             else:
                 print("CUDA is not available")
             self._device = torch.device(device_name)
-            self._checkpoint = torch.load(self._model_file, map_location=self._device)
-
-            # Load model
-            self._model = lcnn.models.hg(
-                depth=M.depth,
-                head=lambda c_in, c_out: MultitaskHead(c_in, c_out),
-                num_stacks=M.num_stacks,
-                num_blocks=M.num_blocks,
-                num_classes=sum(sum(M.head_size, [])),
-            )
-            self._model = MultitaskLearner(self._model)
-            self._model = LineVectorizer(self._model)
-            self._model.load_state_dict(self._checkpoint["model_state_dict"])
-            self._model = self._model.to(self._device)
-            self._model.eval()
+
+            cache_file = None
+            if use_cache and quantize is None:
+                cache_file = wireframe.wireframe_cache.cache_filename(self._config_file, self._model_file, self._device)
+                try:
+                    self._model = wireframe.wireframe_cache.load(cache_file, self._device)
+                except Exception as e:
+                    # A bad cache is rebuilt from the checkpoint below
+                    print("Could not load cached model {}: {}".format(cache_file, e))
+                    self._model = None
+                if self._model is not None:
+                    print("Loaded cached model {}".format(cache_file))
+
+            if self._model is None:
+                self._checkpoint = torch.load(self._model_file, map_location=self._device)
+
+                # Load model
+                self._model = lcnn.models.hg(
+                    depth=M.depth,
+                    head=lambda c_in, c_out: MultitaskHead(c_in, c_out),
+                    num_stacks=M.num_stacks,
+                    num_blocks=M.num_blocks,
+                    num_classes=sum(sum(M.head_size, [])),
+                )
+                self._model = MultitaskLearner(self._model)
+                self._model = LineVectorizer(self._model, compact=True)
+                self._model.load_state_dict(self._checkpoint["model_state_dict"])
+                self._model = self._model.to(self._device)
+                self._model.eval()
+                if cache_file is not None:
+                    wireframe.wireframe_cache.save(self._model, cache_file, self._device)
+                    print("Saved cached model {}".format(cache_file))
+
+            if quantize == "dynamic":
+                self._model = wireframe.wireframe_quantize.quantize_dynamic(self._model)
+            elif quantize == "static":
+                calibration_inputs = []
+                for imname in calibration_images or []:
+                    image = self.preprocess_image(self.load_image(imname))
+                    calibration_inputs.append(torch.from_numpy(image[None].copy()))
+                self._model = wireframe.wireframe_quantize.quantize_static(self._model, calibration_inputs)
             
             self.initialized = True
             
@@ -112,6 +151,16 @@ class Wireframe():
             
         return self.initialized
 
+    def copy(self, num_threads=None):
+        """
+        Returns a new uninitialized Wireframe using the same configuration and model.
+        The copy can be sent to another process and setup there.
+
+        Arguments:
+        num_threads -- (optional) number of torch intra-op threads for the copy
+        """
+        return Wireframe(self._config_file, self._model_file, self._gpu_devices, num_threads=num_threads)
+
     def load_image(self, imname):
         im = skimage.io.imread(imname)
         if im.ndim == 2:
@@ -119,14 +168,67 @@ class Wireframe():
         im = im[:, :, :3]
         return im
     
-    def parse(self, imname):
+    def preprocess_image(self, im):
         """
-        Returns a WireframeRecord of the predictions for the input image filename
+        Resizes and normalizes an image for the LCNN model
+
+        Arguments:
+        im -- image array [H, W, 3] as returned by load_image
+
+        Returns:
+        image -- numpy float32 array [3, 512, 512]
         """
-        im = self.load_image(imname)
         im_resized = skimage.transform.resize(im, (512, 512)) * 255
         image = (im_resized - M.image.mean) / M.image.stddev
-        image = torch.from_numpy(np.rollaxis(image, 2)[None].copy()).float()
+        return np.rollaxis(image, 2).astype(np.float32)
+
+    def parse(self, imname):
+        """
+        Returns a WireframeRecord of the predictions for the input image filename
+        """
+        return self.parse_batch([imname], batch_size=1)[0]
+
+    def parse_batch(self, imnames, batch_size=8):
+        """
+        Returns a list of WireframeRecords for the input image filenames.
+
+        Images are stacked into batches so the model is evaluated once per batch
+        rather than once per image.
+
+        Arguments:
+        imnames -- list of image filenames
+        batch_size -- maximum number of images to run through the model at once (default 8)
+
+        Returns:
+        records -- list of WireframeRecord in the same order as imnames
+        """
+        records = []
+        for start in range(0, len(imnames), batch_size):
+            images = []
+            imshapes = []
+            imnums = []
+            for imname in imnames[start:start + batch_size]:
+                im = self.load_image(imname)
+                images.append(self.preprocess_image(im))
+                imshapes.append(im.shape)
+                imnums.append(wireframe.project.imnum_from_imname(imname))
+            records += self.infer(np.stack(images), imshapes, imnums)
+        return records
+
+    def infer(self, images, imshapes, imnums):
+        """
+        Runs the LCNN model on a batch of preprocessed images
+
+        Arguments:
+        images -- numpy float array [batch, 3, 512, 512] from preprocess_image
+        imshapes -- list [batch] of original image shapes
+        imnums -- list [batch] of image numbers
+
+        Returns:
+        records -- list [batch] of WireframeRecord
+        """
+        n_batch = images.shape[0]
+        image = torch.from_numpy(np.ascontiguousarray(images)).float()
         with torch.no_grad():
             input_dict = {
                 "image": image.to(self._device),
@@ -137,19 +239,23 @@ class Wireframe():
                         "Lpos": torch.zeros(2, 2, dtype=torch.uint8).to(self._device),
                         "Lneg": torch.zeros(2, 2, dtype=torch.uint8).to(self._device),
                     }
+                    for _ in range(n_batch)
                 ],
                 "target": {
-                    "jmap": torch.zeros([1, 1, 128, 128]).to(self._device),
-                    "joff": torch.zeros([1, 1, 2, 128, 128]).to(self._device),
+                    "jmap": torch.zeros([n_batch, 1, 128, 128]).to(self._device),
+                    "joff": torch.zeros([n_batch, 1, 2, 128, 128]).to(self._device),
                 },
                 "mode": "testing",
             }
             H = self._model(input_dict)["preds"]
 
-        return wireframe.wireframe_record.WireframeRecord(H, im.shape, wireframe.project.imnum_from_imname(imname))
-        
-    
+        return [wireframe.wireframe_record.WireframeRecord(H, imshapes[i], imnums[i], index=i)
+                for i in range(n_batch)]
+
     def visualize(self, imname):
+        import matplotlib.pyplot as plt
+        from wireframe.wireframe_plot import PLTOPTS, c
+
         print(f"Processing {imname}")
         rec = self.parse(imname)
         im = self.load_image(imname)
@@ -160,9 +266,9 @@ class Wireframe():
             plt.gca().set_axis_off()
             plt.subplots_adjust(top=1, bottom=0, right=1, left=0, hspace=0, wspace=0)
             plt.margins(0, 0)
-            for (a, b), s in zip(nlines, nscores):
-                if s < t:
-                    continue
+            # Lines are sorted by descending score, so the lines above t are a prefix
+            n = rec.num_above(t, overlap=0.01)
+            for (a, b), s in zip(nlines[:n], nscores[:n]):
                 plt.plot([a[1], b[1]], [a[0], b[0]], c=c(s), linewidth=2, zorder=s)
                 plt.scatter(a[1], a[0], **PLTOPTS)
                 plt.scatter(b[1], b[0], **PLTOPTS)
@@ -0,0 +1,82 @@
+#
+# wireframe_cache.py
+#
+# Caches a TorchScript export of the LCNN backbone next to the checkpoint for fast startup
+#
+
+import os
+
+import torch
+
+from lcnn.config import M
+from lcnn.models.line_vectorizer import LineVectorizer
+from lcnn.models.multitask_learner import MultitaskLearner
+
+import wireframe.project
+import wireframe.wireframe_error
+import wireframe.wireframe_quantize
+
+BACKBONE_PREFIX = "backbone.backbone."
+
+def cache_filename(config_file, model_file, device):
+    """
+    Returns the cache filename prefix for a config, checkpoint and device.
+    The cache lives next to the checkpoint and is keyed by the contents of both files.
+
+    Arguments:
+    config_file -- LCNN yaml configuration file
+    model_file -- LCNN checkpoint file
+    device -- torch.device the model runs on
+    """
+    key = wireframe.project.model_key(config_file, model_file)[:16]
+    return "{}.{}.{}".format(model_file, key, device.type)
+
+def save(model, filename, device):
+    """
+    Exports the model to the cache.
+
+    The hourglass backbone runs on fixed size images so it is traced to TorchScript.
+    The line sampling in LineVectorizer depends on the data, so it stays in python and
+    only its weights are saved.
+
+    Arguments:
+    model -- LineVectorizer model in eval mode
+    filename -- cache filename prefix from cache_filename
+    device -- torch.device the model runs on
+    """
+    hourglass = wireframe.wireframe_quantize.FinalStackHourglass(model.backbone.backbone).eval()
+    example = torch.zeros([1, 3, 512, 512], device=device)
+    with torch.no_grad():
+        traced = torch.jit.trace(hourglass, example, check_trace=False, strict=False)
+
+    # Files are written to temporary names and renamed, so concurrent jobs never see a
+    # partial file. The backbone is replaced last and marks the cache complete.
+    tmp = ".{}.tmp".format(os.getpid())
+    head_state = {k: v for k, v in model.state_dict().items() if not k.startswith(BACKBONE_PREFIX)}
+    torch.save(head_state, filename + ".head.pt" + tmp)
+    torch.jit.save(traced, filename + ".backbone.pt" + tmp)
+    os.replace(filename + ".head.pt" + tmp, filename + ".head.pt")
+    os.replace(filename + ".backbone.pt" + tmp, filename + ".backbone.pt")
+
+def load(filename, device):
+    """
+    Loads a model exported with save.
+
+    Returns:
+    model -- LineVectorizer model in eval mode, or None if there is no cache
+
+    Raises WireframeError if the cached head does not match the model.
+    """
+    if not (os.path.isfile(filename + ".backbone.pt") and os.path.isfile(filename + ".head.pt")):
+        return None
+    traced = torch.jit.load(filename + ".backbone.pt", map_location=device)
+    model = LineVectorizer(MultitaskLearner(wireframe.wireframe_quantize.FinalStackBackbone(traced)), compact=True)
+    # Only the traced backbone weights are expected to be missing from the head
+    missing, unexpected = model.load_state_dict(torch.load(filename + ".head.pt", map_location=device), strict=False)
+    missing = [k for k in missing if not k.startswith(BACKBONE_PREFIX)]
+    if missing or unexpected:
+        raise wireframe.wireframe_error.WireframeError(
+            "Cached model {} does not match: missing keys {}, unexpected keys {}".format(filename, missing, unexpected))
+    model = model.to(device)
+    model.eval()
+    return model
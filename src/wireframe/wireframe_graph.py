@@ -7,19 +7,12 @@
 import numpy as np
 from igraph import Graph
 
-import matplotlib as mpl
-import matplotlib.pyplot as plt
 from collections.abc import Iterable
 
-# Plotting settings
-PLTOPTS = {"color": "#33FFFF", "s": 15, "edgecolors": "none", "zorder": 5}
-cmap = plt.get_cmap("jet")
-norm = mpl.colors.Normalize(vmin=0.9, vmax=1.0)
-sm = plt.cm.ScalarMappable(cmap=cmap, norm=norm)
-sm.set_array([])
+from wireframe.wireframe_render import render_panels
 
-def c(x):
-    return sm.to_rgba(x)
+# Ways of merging line endpoints into graph vertices, see WireframeGraph
+VERTEX_MODES = ("grid", "juncs", "endpoints")
 
 class WireframeGraph():
     """
@@ -31,17 +24,34 @@ class WireframeGraph():
     rec -- reference to the backing wireframe record
     g -- the igraph Graph object
     disc -- the discretization factor used
+    vertices -- vertex builder, one of VERTEX_MODES
+    vertex_idx -- numpy array [num_vertices, 2] of vertex locations in grid cell units,
+        integers for "grid" vertices and fractional for snapped vertices
+    edge_vertices -- int numpy array [num_edges, 2] of (source, target) vertex numbers
+    edge_lines -- int numpy array [num_edges] of the linenum of each edge, also stored as
+        the "line" edge attribute. Lines whose endpoints snap to the same vertex are left
+        out, so with snapped vertices edge numbers and linenums can differ
     t -- threshold level
     """
-    def __init__(self, record, threshold=0.95, name=None):
+    def __init__(self, record, threshold=0.95, name=None, vertices="grid", snap_radius=4.0):
         """
         Arguments:
         record -- a wireframe record object
         threshold -- score threshold value to add lines to graph (default 0.95)
         name -- (optional) name for graph
+        vertices -- how line endpoints are merged into vertices (default "grid"):
+            "grid" -- endpoints in the same cell of a disc x disc grid are merged
+            "juncs" -- endpoints snap to the nearest predicted junction within snap_radius,
+                others are merged as in "endpoints"
+            "endpoints" -- endpoints within snap_radius of each other are merged
+        snap_radius -- snapping distance in pixels for "juncs" and "endpoints" (default 4.0)
         """
+        if vertices not in VERTEX_MODES:
+            raise ValueError("Unknown vertices mode {}, expected one of {}".format(vertices, VERTEX_MODES))
         self.rec = record
         self.t = threshold
+        self.vertices = vertices
+        self.snap_radius = snap_radius
         self.g = Graph()
         if name:
             self.g["name"] = name
@@ -50,106 +60,221 @@ class WireframeGraph():
         self.disc = 100
         self.imshape = self.rec.imshape
         self.imnum = self.rec.imnum
+        # Cache from linenum -> intersection groups, filled by get_intersecting_lines
+        self._intersections = {}
+        # Cache from slack -> intersection_table output
+        self._intersection_tables = {}
 
         self.setup_graph()
 
     def setup_graph(self):
-        # Add vertices to g
+        # Vertices are the distinct discretized endpoints, edges index into them
         nlines, nscores = self.rec.postprocess(self.t)
         all_pts = nlines.reshape((len(nlines) * 2, 2))
-        idxs = self.point_to_vertex(all_pts)
-        # Map for lookup vertex num -> (x, y)
-        idx_list = list(set(idxs))
-        # Map for reverse lookup (x, y) -> vertex num
-        idx_map = {}
-        for i in range(len(idx_list)):
-            idx_map[idx_list[i]] = i
-        self.g.add_vertices(len(idx_list))
-        self.g.vs["idx"] = idx_list
-
-        # Add edges to g
-        edges = []
-        for l in nlines:
-            idxs = self.point_to_vertex(l)
-            edges.append((idx_map[idxs[0]], idx_map[idxs[1]]))
-        self.g.add_edges(edges)
-        self.g.es["score"] = nscores
+        if self.vertices == "grid":
+            self.vertex_idx, inverse = np.unique(self.point_to_vertex(all_pts), axis=0, return_inverse=True)
+        else:
+            anchors = self.rec.juncs() * self.imshape[:2] if self.vertices == "juncs" else None
+            vertex_pts, inverse = snap_points(all_pts, self.snap_radius, anchors)
+            self.vertex_idx = (vertex_pts * self.disc) / self.imshape[:2]
+        edge_vertices = inverse.reshape((-1, 2))
+        keep = np.ones(len(edge_vertices), dtype=bool)
+        if self.vertices != "grid":
+            # Lines shorter than the snap radius collapse to a single vertex
+            keep = edge_vertices[:, 0] != edge_vertices[:, 1]
+        self.edge_vertices = edge_vertices[keep]
+        self.edge_lines = np.nonzero(keep)[0]
+        self._line_edge = np.full(len(keep), -1, dtype=int)
+        self._line_edge[self.edge_lines] = np.arange(len(self.edge_lines))
+
+        self.g.add_vertices(len(self.vertex_idx))
+        self.g.vs["idx"] = [tuple(v) for v in self.vertex_idx.tolist()]
+        self.g.add_edges(self.edge_vertices.tolist())
+        self.g.es["score"] = np.asarray(nscores)[keep].tolist()
+        self.g.es["line"] = self.edge_lines.tolist()
 
     def point_to_vertex(self, pts):
         """
-        Returns the (i, j) indices that correspond to the discretized location of pt
+        Returns the (i, j) indices that correspond to the discretized location of pts
 
         Arguments:
         pts -- numpy float array [num_pts, 2] or [2]
 
         Returns:
-        idxs -- list [num_pts] of int tuples [2]
+        idxs -- int numpy array [num_pts, 2]
         """
-        result = []
-        arr = ((pts * self.disc) / self.imshape[:2]).astype(int)
-        for i, j in arr:
-            result.append((i, j))
-        return result
+        pts = np.asarray(pts).reshape((-1, 2))
+        return ((pts * self.disc) / self.imshape[:2]).astype(int)
 
     def vertex_to_point(self, vertices):
         """
-        Returns the (x, y) cell coords that correspond to a discretized vertex
+        Returns the (x, y) cell coords that correspond to discretized vertices
 
         Arguments:
-        vertices -- list of tuples [num_pts, 2]
+        vertices -- int numpy array or list of tuples [num_pts, 2]
 
         Returns:
         pts -- numpy float array [num_pts, 2]
         """
-        num_pts = len(vertices)
-        result = np.zeros((num_pts, 2))
-        for i, v in enumerate(vertices):
-            result[i] = (np.array(v) * self.imshape[:2]) / self.disc
-        return result
+        vertices = np.asarray(vertices, dtype=np.float64).reshape((-1, 2))
+        return (vertices * self.imshape[:2]) / self.disc
+
+    def graph_segments(self, graph):
+        """
+        Returns the edges of a graph built from this one as plot segments
 
-    def plot_graph(self, graph, im, highlight=[]):
+        Arguments:
+        graph -- igraph Graph, e.g. self.g or one of connected_subgraphs
+
+        Returns:
+        segments -- numpy float array [num_edges, 2, 2] of (x, y) image coordinates
+        """
+        idx = np.array(graph.vs["idx"], dtype=np.float64).reshape((-1, 2))
+        edges = np.array(graph.get_edgelist(), dtype=int).reshape((-1, 2))
+        return self.vertex_to_point(idx)[:, ::-1][edges]
+
+    def plot_graph(self, graph, im, highlight=[], renderer=None, filename=None):
+        """
+        Plots a graph over its image, highlighted edges in blue and others in red
+
+        Arguments:
+        graph -- igraph Graph, e.g. self.g or one of connected_subgraphs
+        im -- image array or filename
+        highlight -- linenums of the edges to highlight
+        renderer -- (optional) WireframeRenderer to queue the figure on instead of showing it
+        filename -- (optional) PNG filename of the rendered figure (default graph_<imnum>.png)
+        """
         print("Plotting graph:\n{}\n".format(graph))
-        plt.gca().set_axis_off()
-        plt.subplots_adjust(top=1, bottom=0, right=1, left=0, hspace=0, wspace=0)
-        plt.margins(0, 0)
-        for i, edge in enumerate(graph.es):
-            s = graph.es["score"][edge.index]
-            vs = [graph.vs["idx"][edge.source], graph.vs["idx"][edge.target]]
-            pts = self.vertex_to_point(vs)
-            plt.plot([pts[0, 1], pts[1, 1]], [pts[0, 0], pts[1, 0]], c='b' if i in highlight else 'r', linewidth=2)
-            plt.scatter(pts[0, 1], pts[0, 0], **PLTOPTS)
-            plt.scatter(pts[1, 1], pts[1, 0], **PLTOPTS)
-        plt.gca().xaxis.set_major_locator(plt.NullLocator())
-        plt.gca().yaxis.set_major_locator(plt.NullLocator())
-        plt.imshow(im)
-        plt.show()
-        plt.close()
+        colors = np.where(np.isin(np.array(graph.es["line"], dtype=int), highlight), 'b', 'r')
+        panel = {"image": im, "segments": self.graph_segments(graph), "colors": colors.tolist(), "points": True}
+        if renderer is not None:
+            renderer.submit(filename or "graph_{}.png".format(self.imnum), [panel])
+        else:
+            render_panels([panel])
 
     def connected_subgraphs(self):
         return self.g.components().subgraphs()
 
+    def intersection_groups(self, linenums=None, close=0.05):
+        """
+        Computes the intersection groups of several lines at once
+
+        Arguments:
+        linenums -- (optional) lines to compute groups for. Defaults to every line in the graph
+        close -- distance tolerance for grouping intersection points (default 0.05)
+
+        Returns:
+        groups -- dict from linenum -> list of groups as returned by get_intersecting_lines
+        """
+        if linenums is None:
+            linenums = self.edge_lines.tolist()
+        return {linenum: self.get_intersecting_lines(linenum, close) for linenum in linenums}
+
     def get_intersecting_lines(self, linenum, close=0.05):
-        edge = self.g.es[linenum]
-        line = np.array([self.g.vs["idx"][edge.source], self.g.vs["idx"][edge.target]])
-        result = []
-        points = []
-        for i, l in enumerate(self.g.es):
-            if i == linenum:
-                continue
-            other_line = np.array([self.g.vs["idx"][l.source], self.g.vs["idx"][l.target]])
-            intersect, p = intersect_2d(line, other_line)
-            if not intersect:
-                continue
-            if not points:
-                points.append(p)
-                result.append([i])
-            else:
-                for group, prev_p in enumerate(points):
-                    if np.linalg.norm(p - prev_p) < close:
-                        result[group].append(i)
-                        break
+        """
+        Returns the lines intersecting a line, grouped by intersection point.
+        Results are cached per (linenum, close) and shared between callers, so they
+        should not be modified.
+
+        Arguments:
+        linenum -- index of the line in the thresholded record lines
+        close -- distance tolerance for grouping intersection points (default 0.05)
+
+        Returns:
+        result -- list of groups, each a list of linenums. Empty for lines left out of the graph
+        """
+        key = (linenum, close)
+        if key not in self._intersections:
+            self._intersections[key] = self._get_intersecting_lines(linenum, close)
+        return self._intersections[key]
+
+    def intersection_table(self, slack=0.05):
+        """
+        Returns the intersections between all pairs of lines in the graph, computed once
+        per slack in a single vectorized pass and cached. Line coordinates are the
+        discretized vertex locations, as in get_intersecting_lines.
+
+        Arguments:
+        slack -- tolerance for intersection points past the line endpoints (default 0.05)
+
+        Returns:
+        offsets -- int numpy array [num_lines + 1], line i intersects others[offsets[i]:offsets[i + 1]],
+            an empty range for lines left out of the graph
+        others -- int numpy array [num_intersections] of intersecting linenums, ascending per line
+        points -- numpy float array [num_intersections, 2] of intersection points
+        """
+        if slack not in self._intersection_tables:
+            lines = self.vertex_idx[self.edge_vertices].astype(np.float64)
+            offsets, others, points = intersect_2d_table(lines, slack)
+            # Map edge numbers back to linenums
+            counts = np.zeros(len(self._line_edge), dtype=int)
+            counts[self.edge_lines] = np.diff(offsets)
+            offsets = np.concatenate([[0], np.cumsum(counts)])
+            self._intersection_tables[slack] = (offsets, self.edge_lines[others], points)
+        return self._intersection_tables[slack]
+
+    def _get_intersecting_lines(self, linenum, close):
+        offsets, others, points = self.intersection_table()
+        start, end = offsets[linenum], offsets[linenum + 1]
+        return group_points(points[start:end], others[start:end], close)
+
+class WireframeGraphSet():
+    """
+    WireframeGraphSet
+
+    Builds the WireframeGraph of each record once, on first use, and reuses it afterwards.
+    Graphs keep their intersection groups cached, so repeated lookups of the same line
+    are also free.
+
+    Attributes:
+    records -- dict from imnum -> WireframeRecord
+    t -- threshold level of the graphs
+    """
+    def __init__(self, records, threshold=0.95, **kwargs):
+        """
+        Arguments:
+        records -- iterable of WireframeRecord, or dict from imnum -> WireframeRecord
+        threshold -- score threshold value to add lines to graphs (default 0.95)
+        kwargs -- passed to WireframeGraph, e.g. vertices and snap_radius
+        """
+        if isinstance(records, dict):
+            records = records.values()
+        self.records = {r.imnum: r for r in records}
+        self.t = threshold
+        self.kwargs = kwargs
+        self._graphs = {}
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, imnum):
+        return imnum in self.records
 
-        return result
+    def __getitem__(self, imnum):
+        return self.get(imnum)
+
+    def get(self, imnum, threshold=None):
+        """
+        Returns the graph of an image, building it the first time
+
+        Arguments:
+        imnum -- image number of the record
+        threshold -- (optional) score threshold, defaults to the set threshold
+
+        Returns:
+        graph -- WireframeGraph
+        """
+        threshold = self.t if threshold is None else threshold
+        key = (imnum, threshold)
+        if key not in self._graphs:
+            self._graphs[key] = WireframeGraph(self.records[imnum], threshold=threshold, **self.kwargs)
+        return self._graphs[key]
+
+    def get_intersecting_lines(self, imnum, linenum, close=0.05):
+        """
+        Returns get_intersecting_lines for a line of an image's graph
+        """
+        return self.get(imnum).get_intersecting_lines(linenum, close)
 
 ###############################################################
 # Utility functions
@@ -183,4 +308,126 @@ def intersect_2d(l1, l2, slack=0.05):
 
     return True, p
 
+def snap_points(pts, radius, anchors=None):
+    """
+    Merges points into vertices using KD-tree radius queries. Points within radius of an
+    anchor snap to the nearest anchor. The remaining points are clustered greedily: in
+    order, each unassigned point seeds a cluster that takes every unassigned point within
+    radius of it, so clusters are at most 2 * radius across. Clusters are placed at the
+    mean of their points.
+
+    Arguments:
+    pts -- numpy float array [num_pts, 2]
+    radius -- snapping distance
+    anchors -- (optional) numpy float array [num_anchors, 2], e.g. predicted junctions
+
+    Returns:
+    vertices -- numpy float array [num_vertices, 2]
+    inverse -- int numpy array [num_pts] of vertex numbers for each point
+    """
+    from scipy.spatial import cKDTree
+
+    pts = np.asarray(pts, dtype=np.float64).reshape((-1, 2))
+    inverse = np.full(len(pts), -1, dtype=int)
+    vertices = np.zeros((0, 2))
+
+    if anchors is not None and len(anchors) > 0 and len(pts) > 0:
+        anchors = np.asarray(anchors, dtype=np.float64).reshape((-1, 2))
+        dist, nearest = cKDTree(anchors).query(pts, distance_upper_bound=radius)
+        hit = np.isfinite(dist)
+        used, inv = np.unique(nearest[hit], return_inverse=True)
+        inverse[hit] = inv.reshape(-1)
+        vertices = anchors[used]
+
+    rest = np.nonzero(inverse < 0)[0]
+    if len(rest) > 0:
+        rest_pts = pts[rest]
+        neighbors = cKDTree(rest_pts).query_ball_point(rest_pts, radius)
+        labels = np.full(len(rest), -1, dtype=int)
+        num_clusters = 0
+        for seed in range(len(rest)):
+            if labels[seed] >= 0:
+                continue
+            members = np.asarray(neighbors[seed], dtype=int)
+            labels[members[labels[members] < 0]] = num_clusters
+            num_clusters += 1
+        centers = np.zeros((num_clusters, 2))
+        np.add.at(centers, labels, rest_pts)
+        centers /= np.bincount(labels, minlength=num_clusters)[:, None]
+        inverse[rest] = labels + len(vertices)
+        vertices = np.concatenate([vertices, centers])
+
+    return vertices, inverse
+
+def intersect_2d_table(lines, slack=0.05, chunk_size=256):
+    """
+    Vectorized intersect_2d between all pairs of lines
+
+    Arguments:
+    lines -- numpy array [num_lines, 2, 2]
+    slack -- tolerance for intersection points past the line endpoints (default 0.05)
+    chunk_size -- number of lines compared against all others at once (default 256)
+
+    Returns:
+    offsets -- int numpy array [num_lines + 1], line i intersects others[offsets[i]:offsets[i + 1]]
+    others -- int numpy array [num_intersections] of intersecting line indices, ascending per line
+    points -- numpy float array [num_intersections, 2] of intersection points
+    """
+    num_lines = len(lines)
+    start = lines[:, 0]
+    d = lines[:, 1] - start
+    # Homogeneous line coordinates, as in intersect_2d
+    U = np.stack([-d[:, 1], d[:, 0], d[:, 1] * start[:, 0] - d[:, 0] * start[:, 1]], axis=1)
+
+    rows, cols, pts = [], [], []
+    for c0 in range(0, num_lines, chunk_size):
+        c1 = min(c0 + chunk_size, num_lines)
+        P = np.cross(U[c0:c1, None, :], U[None, :, :])
+        valid = ~np.isclose(P[..., 2], 0)
+        valid[np.arange(c1 - c0), np.arange(c0, c1)] = False
+        with np.errstate(divide="ignore", invalid="ignore"):
+            p = P[..., :2] / P[..., 2:]
+        # Check that p lies between each endpoint of both lines
+        d1 = d[c0:c1, None, :]
+        valid &= np.sum((p - start[c0:c1, None, :]) * d1, axis=2) >= -slack
+        valid &= np.sum((lines[c0:c1, None, 1, :] - p) * d1, axis=2) >= -slack
+        valid &= np.sum((p - start[None, :, :]) * d[None, :, :], axis=2) >= -slack
+        valid &= np.sum((lines[None, :, 1, :] - p) * d[None, :, :], axis=2) >= -slack
+        r, c = np.nonzero(valid)
+        rows.append(r + c0)
+        cols.append(c)
+        pts.append(p[r, c])
+
+    if num_lines == 0:
+        return np.zeros(1, dtype=int), np.zeros(0, dtype=int), np.zeros((0, 2))
+    rows = np.concatenate(rows)
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=num_lines))])
+    return offsets, np.concatenate(cols), np.concatenate(pts)
+
+def group_points(points, labels, close=0.05):
+    """
+    Groups labels by their points: each point joins the first group whose first point is
+    within close of it, or starts a new group
+
+    Arguments:
+    points -- numpy float array [num_points, 2]
+    labels -- sequence [num_points] of labels to group
+    close -- distance tolerance for joining a group (default 0.05)
+
+    Returns:
+    groups -- list of lists of labels
+    """
+    dist = np.linalg.norm(points[:, None, :] - points[None, :, :], axis=2)
+    groups = []
+    group_firsts = []
+    for i in range(len(points)):
+        for group, first in enumerate(group_firsts):
+            if dist[i, first] < close:
+                groups[group].append(int(labels[i]))
+                break
+        else:
+            group_firsts.append(i)
+            groups.append([int(labels[i])])
+    return groups
+
 
@@ -0,0 +1,19 @@
+#
+# wireframe_plot.py
+#
+# Shared matplotlib settings for plotting wireframe information.
+# Imported on demand by plotting functions so matplotlib only loads when plotting.
+#
+
+import matplotlib as mpl
+import matplotlib.pyplot as plt
+
+# Plotting settings
+PLTOPTS = {"color": "#33FFFF", "s": 15, "edgecolors": "none", "zorder": 5}
+cmap = plt.get_cmap("jet")
+norm = mpl.colors.Normalize(vmin=0.9, vmax=1.0)
+sm = plt.cm.ScalarMappable(cmap=cmap, norm=norm)
+sm.set_array([])
+
+def c(x):
+    return sm.to_rgba(x)
@@ -6,8 +6,10 @@
 
 import numpy as np
 import os
-import cv2
 
+import wireframe.point_index
+import wireframe.point_store
+import wireframe.wireframe_error
 import wireframe.wireframe_ransac
 
 import myply
@@ -23,7 +25,10 @@ class WireframePointCloud():
     info -- Structure for Motion information, including a point cloud
     cam -- camera parameters from OpenSfM
 
-    _line_point_clouds -- Point clouds corresponding to detected line features
+    _visible -- indices of the points kept by cull_points
+    _depths -- camera frame depth of each visible point
+    _store -- PointStore holding the points of this shot
+    _line_point_idx -- Point store indices of the point clouds corresponding to detected line features
     _fitted_3d_lines   -- Fitted 3D lines given by (start, end) corresponding to detected line features
     """
     def __init__(self, project_dir, imname, rec, iminfo, caminfo, **kwargs):
@@ -34,6 +39,12 @@ class WireframePointCloud():
         threshold -- line score threshold value in [0.0, 1.0]
         distance -- required distance projected 2D points need to be in line point cloud
         color -- [r, g, b] or None, in which case color is chosen randomly for each line
+        point_store -- PointStore with this shot's points, shared between shots. If None a
+                       store is built from iminfo
+        line_chunk_size -- number of lines matched to points at once, bounds memory (default 256)
+        min_depth -- points with camera frame depth at most min_depth are culled (default 0.0)
+        frustum_padding -- points projecting further than this fraction of the image size
+                           outside the image are culled (default 0.25)
         """
         self.imname = imname
         start = -1
@@ -62,53 +73,122 @@ class WireframePointCloud():
         self._line_inlier_thresh = kwargs.get("line_inlier_thresh", 0.25)
         self._min_line_inliers = kwargs.get("min_line_inliers", 5)
         self._color_inliers = kwargs.get("color_inliers", False)
+        self._line_chunk_size = kwargs.get("line_chunk_size", 256)
+        self._min_depth = kwargs.get("min_depth", 0.0)
+        self._frustum_padding = kwargs.get("frustum_padding", 0.25)
 
         # The ::-1 reverses the endpoints from (y, x) to (x, y)
         initial_lines = rec.postprocess(self._threshold)[0][:, :, ::-1]
         self.initial_lines = initial_lines
 
-        self._points = np.array(self.info["vertices"])
+        # Line point clouds are index arrays into a read only store shared between shots
+        self._store = kwargs.get("point_store", None)
+        if self._store is None:
+            self._store = wireframe.point_store.PointStore.from_shots({imname: iminfo})
+        self._points = self._store.shot_points(imname)
+        self._point_offset = self._store.shot_range(imname)[0]
         self._R = np.array(self.info["rotation"])
         self._T = np.array(self.info["translation"])
         self._K, self._distortion = get_K_dist(self.cam)
-        self._points_proj = self.project_points(self._points)
+        self._image_size = get_image_size(self.cam)
+        # Only points in front of the camera and inside the padded image are projected
+        self._visible, self._depths = self.cull_points(self._points)
+        self._points_proj = self.project_points(self._points[self._visible])
 
         # Data structure for all the points corresponding to each line
         # Length is number of lines
-        # Elements are numpy arrays of points
-        self._line_point_clouds = []
-        for l in initial_lines:
-            l_points_idx, _ = get_points_near_line_2D(self._points_proj, l, dist=self._2d_distance)
-            l_points_idx = l_points_idx[0]
-            self._line_point_clouds.append(self._points[l_points_idx, :])
+        # Elements are numpy arrays of point store indices
+        self._line_point_idx = []
+        offsets, l_points_idx = get_points_near_lines_2D(self._points_proj, initial_lines, dist=self._2d_distance,
+                                                         chunk_size=self._line_chunk_size)
+        l_points_idx = self._visible[l_points_idx] + self._point_offset
+        for i in range(len(initial_lines)):
+            self._line_point_idx.append(l_points_idx[offsets[i]:offsets[i + 1]])
 
         # Data structure for all the fitted 3d lines corresponding to each point cloud
         # Length is number of lines
         # Elements are numpy arrays of shape [2, 3]
         self._fitted_3d_lines = []
-        self.fitter = wireframe.wireframe_ransac.Line3DRANSAC(self._line_ransac_iterations, self._line_inlier_thresh, None)
-        for cloud in self._line_point_clouds:
-            line, n_inliers = self.fitter.ransac(cloud)
-            if n_inliers < self._min_line_inliers:
+        self.fitter = wireframe.wireframe_ransac.BatchLine3DRANSAC(self._line_ransac_iterations, self._line_inlier_thresh, None)
+        # All line clouds are fit together, l_points_idx holds them concatenated
+        lines, line_inliers = self.fitter.ransac_batch(self._store.gather(l_points_idx), offsets)
+        for line, n_inliers in zip(lines, line_inliers):
+            if n_inliers < self._min_line_inliers or not np.all(np.isfinite(line)):
                 line = np.array([])
             self._fitted_3d_lines.append(line)
 
         if self._color_inliers:
             # Data structure for all the colors of inliers
             self._c = []
-            for cloud, line in zip(self._line_point_clouds, self._fitted_3d_lines):
+            for idx, line in zip(self._line_point_idx, self._fitted_3d_lines):
                 if line.shape[0] == 0:
-                    self._c.append(np.broadcast_to(np.array([255, 0, 0]), (cloud.shape[0], 3)))
+                    self._c.append(np.broadcast_to(np.array([255, 0, 0]), (idx.shape[0], 3)))
                     continue
-                error = self.fitter.get_error(cloud, line)
+                error = self.fitter.get_error(self._store.gather(idx), line)
                 colors = np.where(np.expand_dims(error < self._line_inlier_thresh, 1), np.array([[255, 255, 255]]), np.array([[255, 0, 0]]))
                 colors = np.vstack([colors, np.broadcast_to(255, (4, 3))])
                 self._c.append(colors)
 
+    def __getstate__(self):
+        # Shot points are a view into the point store, which pickles on its own
+        state = self.__dict__.copy()
+        del state["_points"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._points = self._store.shot_points(self.imname)
+
+    def attach_store(self, point_store):
+        """
+        Replaces the point store with another one holding the same points, e.g. the
+        in-memory store a memory mapped copy was saved from
+        """
+        self._store = point_store
+        self._points = point_store.shot_points(self.imname)
+
+    def line_point_cloud(self, i):
+        """
+        Returns the points of the i-th line point cloud, gathered from the point store
+
+        Returns:
+        cloud -- numpy array [num_points, 3]
+        """
+        return self._store.gather(self._line_point_idx[i])
+
+    def cull_points(self, points):
+        """
+        Transforms points into the camera frame and keeps the points in front of the camera
+        whose undistorted projection falls inside the padded image
+
+        Arguments:
+        points -- numpy array [num_points, 3]
+
+        Returns:
+        visible -- int numpy array of the indices of kept points, ascending
+        depths -- numpy array of the camera frame depth of each kept point
+        """
+        cam_points = points @ rotation_matrix(self._R).T + self._T
+        depths = cam_points[:, 2]
+        in_front = depths > self._min_depth
+        with np.errstate(divide="ignore", invalid="ignore"):
+            u = self._K[0, 0] * cam_points[:, 0] / depths + self._K[0, 2]
+            v = self._K[1, 1] * cam_points[:, 1] / depths + self._K[1, 2]
+        width, height = self._image_size
+        pad = self._frustum_padding
+        in_frame = ((u >= -pad * width) & (u <= (1 + pad) * width) &
+                    (v >= -pad * height) & (v <= (1 + pad) * height))
+        visible = np.nonzero(in_front & in_frame)[0]
+        return visible, depths[visible]
+
     def project_points(self, points):
         """
         Computes point projection
         """
+        import cv2
+
+        if len(points) == 0:
+            return np.zeros((0, 1, 2))
         res, _ = cv2.projectPoints(points, self._R, self._T, self._K, self._distortion)
         return np.array(res)
 
@@ -169,7 +249,8 @@ class WireframePointCloud():
         Returns a list of tuples (imname, imnum, PLY) for each line in WPC
         """
         ret = []
-        for i, (pt_cloud, line) in enumerate(zip(self._line_point_clouds, self._fitted_3d_lines)):
+        for i, line in enumerate(self._fitted_3d_lines):
+            pt_cloud = self.line_point_cloud(i)
             if pt_cloud.shape[0] == 0 and line.shape[0] == 0:
                 ret.append((self.imnum, i, myply.PLY(None, None, None)))
             vertices = [myply.Vertex(p[0], p[1], p[2]) for p in pt_cloud]
@@ -186,9 +267,10 @@ class WireframePointCloud():
         Creates ply files for each line point cloud
         """
         os.makedirs(self._wireframe_ply_dir, exist_ok=True)
-        for i, (pt_cloud, line) in enumerate(zip(self._line_point_clouds, self._fitted_3d_lines)):
-            if pt_cloud.shape[0] == 0 and line.shape[0] == 0:
+        for i, (idx, line) in enumerate(zip(self._line_point_idx, self._fitted_3d_lines)):
+            if idx.shape[0] == 0 and line.shape[0] == 0:
                 continue
+            pt_cloud = self._store.gather(idx)
             vertices = pt_cloud
             edges = None
             if line.shape[0] == 2:
@@ -205,25 +287,27 @@ class WireframePointCloud():
         Arguments:
         other_wpc -- The other WireframePointCloud to add to this object
         """
-        for idx in range(len(other_wpc._line_point_clouds)):
-            pc = other_wpc._line_point_clouds[idx]
+        if other_wpc._store is not self._store:
+            raise wireframe.wireframe_error.WireframeError("Combined point clouds must share a PointStore")
+        for idx in range(len(other_wpc._line_point_idx)):
+            pc_idx = other_wpc._line_point_idx[idx]
             line = other_wpc._fitted_3d_lines[idx]
-            self._line_point_clouds.append(pc)
+            self._line_point_idx.append(pc_idx)
             self._fitted_3d_lines.append(line)
             if self._color_inliers:
                 if line.shape[0] == 0:
-                    self._c.append(np.broadcast_to(np.array([255, 0, 0]), (pc.shape[0], 3)))
+                    self._c.append(np.broadcast_to(np.array([255, 0, 0]), (pc_idx.shape[0], 3)))
                 else:
-                    error = self.fitter.get_error(pc, line)
+                    error = self.fitter.get_error(self._store.gather(pc_idx), line)
                     colors = np.where(np.expand_dims(error < self._line_inlier_thresh, 1), np.array([[255, 255, 255]]), np.array([[255, 0, 0]]))
                     colors = np.vstack([colors, np.broadcast_to(255, (4, 3))])
                     self._c.append(colors)
 
         iterations = 0
-        print("[WPC DEBUG] Iter: {}, Num Point Clouds: {}".format(iterations, len(self._line_point_clouds)))
+        print("[WPC DEBUG] Iter: {}, Num Point Clouds: {}".format(iterations, len(self._line_point_idx)))
         while self.simplify():
             iterations += 1
-            print("[WPC DEBUG] Iter: {}, Num Point Clouds: {}".format(iterations, len(self._line_point_clouds)))
+            print("[WPC DEBUG] Iter: {}, Num Point Clouds: {}".format(iterations, len(self._line_point_idx)))
         print("[WPC DEBUG] Combining took {} iterations".format(iterations))
 
     def simplify(self):
@@ -238,16 +322,15 @@ class WireframePointCloud():
         new_3d_lines = []
         if self._color_inliers:
             new_c = []
-        while len(self._line_point_clouds) > 0:
-            cloud = self._line_point_clouds.pop(0)
+        while len(self._line_point_idx) > 0:
+            cloud_idx = self._line_point_idx.pop(0)
             line = self._fitted_3d_lines.pop(0)
             if line.shape[0] == 0:
                 # Point cloud doesn't have a fitted line, so drop point cloud
                 continue
 
-            num_points = cloud.shape[0]
             to_combine = []
-            for i, (pc, l) in enumerate(zip(self._line_point_clouds, self._fitted_3d_lines)):
+            for i, l in enumerate(self._fitted_3d_lines):
                 if l.shape[0] == 0:
                     # No fitted line, so ignore
                     continue
@@ -255,31 +338,28 @@ class WireframePointCloud():
                 if lines_overlap(line, l) and lines_close(line, l):
                     ret = True
                     to_combine.append(i)
-                    num_points += pc.shape[0]
 
             # Shortcut if no overlaps found
             if len(to_combine) == 0:
-                new_point_clouds.append(cloud)
+                new_point_clouds.append(cloud_idx)
                 new_3d_lines.append(line)
                 if self._color_inliers:
-                    error = self.fitter.get_error(cloud, line)
+                    error = self.fitter.get_error(self._store.gather(cloud_idx), line)
                     colors = np.where(np.expand_dims(error < self._line_inlier_thresh, 1), np.array([[255, 255, 255]]), np.array([[255, 0, 0]]))
                     colors = np.vstack([colors, np.broadcast_to(255, (4, 3))])
                     new_c.append(colors)
                 continue
 
             # Compute new cloud and line
-            new_cloud = np.ndarray((num_points, 3))
-            idx = cloud.shape[0]
-            new_cloud[0:idx, :] = cloud
+            new_cloud_idx = [cloud_idx]
             for i in sorted(to_combine, reverse=True):
                 # Pop to remove from list
-                pc = self._line_point_clouds.pop(i)
-                l = self._fitted_3d_lines.pop(i)
-                new_cloud[idx:idx + pc.shape[0], :] = pc
-                idx += pc.shape[0]
+                new_cloud_idx.append(self._line_point_idx.pop(i))
+                self._fitted_3d_lines.pop(i)
+            new_cloud_idx = np.concatenate(new_cloud_idx)
+            new_cloud = self._store.gather(new_cloud_idx)
 
-            new_point_clouds.append(new_cloud)
+            new_point_clouds.append(new_cloud_idx)
             new_line, n_inliers = self.fitter.ransac(new_cloud)
             if n_inliers < self._min_line_inliers:
                 new_line = np.array([])
@@ -294,7 +374,7 @@ class WireframePointCloud():
                     new_c.append(colors)
 
         # Update data structures
-        self._line_point_clouds = new_point_clouds
+        self._line_point_idx = new_point_clouds
         self._fitted_3d_lines = new_3d_lines
         if self._color_inliers:
             self._c = new_c
@@ -319,6 +399,25 @@ def get_K_dist(camera):
     distortion = np.array([k1, k2, 0, 0, 0])
     return K, distortion
 
+def get_image_size(camera):
+    camera_name = next(iter(camera.keys()))
+    return camera[camera_name]["width"], camera[camera_name]["height"]
+
+def rotation_matrix(rotation):
+    """
+    Returns the rotation matrix of an axis-angle rotation vector (Rodrigues' formula)
+
+    Arguments:
+    rotation -- numpy array [3], as stored in OpenSfM shot information
+    """
+    rotation = np.asarray(rotation, dtype=np.float64).reshape(3)
+    theta = np.linalg.norm(rotation)
+    if theta < 1e-12:
+        return np.eye(3)
+    kx, ky, kz = rotation / theta
+    cross = np.array([[0, -kz, ky], [kz, 0, -kx], [-ky, kx, 0]])
+    return np.eye(3) + np.sin(theta) * cross + (1 - np.cos(theta)) * (cross @ cross)
+
 def get_points_near_line_2D(points, line, dist=20.0):
     """
     Returns the indices and points close to line.
@@ -337,6 +436,53 @@ def get_points_near_line_2D(points, line, dist=20.0):
     condition = np.logical_and(close_enough, in_interval)
     return np.nonzero(condition), points[condition]
 
+def get_points_near_lines_2D(points, lines, dist=20.0, chunk_size=256):
+    """
+    Returns the indices of the points close to each line, the same points as
+    get_points_near_line_2D for every line, as a sparse line -> point incidence.
+    Points are bucketed in a grid once, then chunk_size lines at a time are tested
+    against the points in nearby cells in one vectorized pass.
+    2D case.
+
+    Arguments:
+    points -- numpy array of shape [num_points, 2] or [num_points, 1, 2]
+    lines -- numpy array of shape [num_lines, 2, 2]
+    dist -- maximum distance from the line (default 20.0)
+    chunk_size -- number of lines tested at once (default 256)
+
+    Returns:
+    offsets -- int numpy array [num_lines + 1], line i is close to points indices[offsets[i]:offsets[i + 1]]
+    indices -- int numpy array of point indices, ascending per line
+    """
+    points = np.asarray(points).reshape((-1, 2))
+    lines = np.asarray(lines, dtype=np.float64).reshape((-1, 2, 2))
+    point_index = wireframe.point_index.PointIndex.around_segments(points, lines, dist)
+
+    counts = []
+    indices = []
+    for c0 in range(0, len(lines), chunk_size):
+        chunk = lines[c0:c0 + chunk_size]
+        cand_offsets, cand = point_index.candidates(chunk, dist)
+        line = np.repeat(np.arange(len(chunk)), np.diff(cand_offsets))
+
+        # Same tests as get_points_near_line_2D, for every (line, candidate point) pair
+        start = chunk[:, 0]
+        d = chunk[:, 1] - start
+        norm = np.linalg.norm(d, axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            perp_dir = np.stack([-d[:, 1], d[:, 0]], axis=1) / norm[:, None]
+            v = points[cand] - start[line]
+            distances = v[:, 0] * perp_dir[line, 0] + v[:, 1] * perp_dir[line, 1]
+            ts = v[:, 0] * d[line, 0] + v[:, 1] * d[line, 1]
+            condition = (np.abs(distances) < dist) & (0 < ts) & (ts < norm[line] ** 2)
+        counts.append(np.bincount(line[condition], minlength=len(chunk)))
+        indices.append(cand[condition])
+
+    if len(lines) == 0:
+        return np.zeros(1, dtype=int), np.zeros(0, dtype=int)
+    offsets = np.concatenate([[0], np.cumsum(np.concatenate(counts))])
+    return offsets, np.concatenate(indices)
+
 def lines_overlap(l1, l2):
     """
     Determines if 3D line segments overlap.
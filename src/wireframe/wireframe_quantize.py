@@ -0,0 +1,84 @@
+#
+# wireframe_quantize.py
+#
+# Helpers for quantizing the LCNN model to int8 for CPU inference
+#
+
+import torch
+import torch.nn as nn
+
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+import wireframe.wireframe_error
+
+QUANTIZE_MODES = ("dynamic", "static")
+
+class FinalStackHourglass(nn.Module):
+    """
+    Wraps an HourglassNet so it always runs in final_only mode.
+
+    Static quantization traces the backbone with a fixed signature, so the
+    final_only flag is fixed to the value used for inference.
+    """
+    def __init__(self, hourglass):
+        super().__init__()
+        self.hourglass = hourglass
+
+    def forward(self, x):
+        return self.hourglass(x, final_only=True)
+
+class FinalStackBackbone(nn.Module):
+    """
+    Drop in replacement for the HourglassNet backbone from a converted module
+    (quantized or traced) that was built from a FinalStackHourglass.
+
+    Only supports inference: the final_only argument is accepted for compatibility
+    with MultitaskLearner but only the last stack's output is ever returned.
+    """
+    def __init__(self, module):
+        super().__init__()
+        self.module = module
+
+    def forward(self, x, final_only=True):
+        return self.module(x)
+
+def quantize_dynamic(model):
+    """
+    Quantizes the linear layers of the model (the LineVectorizer fc2 MLP) to int8.
+    Weights are quantized ahead of time, activations on the fly.
+
+    Arguments:
+    model -- LineVectorizer model in eval mode on the cpu
+
+    Returns:
+    model -- quantized model
+    """
+    return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+def quantize_static(model, calibration_inputs, backend="fbgemm"):
+    """
+    Quantizes the hourglass convolutions of the model to int8 using calibration data,
+    and the LineVectorizer fc2 MLP dynamically.
+
+    Arguments:
+    model -- LineVectorizer model in eval mode on the cpu
+    calibration_inputs -- list of image tensors [1, 3, 512, 512] used to observe activation ranges
+    backend -- quantized engine to target (default fbgemm for x86)
+
+    Returns:
+    model -- quantized model
+    """
+    if len(calibration_inputs) == 0:
+        raise wireframe.wireframe_error.WireframeError("Static quantization requires calibration images")
+
+    torch.backends.quantized.engine = backend
+    # LineVectorizer -> MultitaskLearner -> HourglassNet
+    learner = model.backbone
+    hourglass = FinalStackHourglass(learner.backbone).eval()
+    prepared = prepare_fx(hourglass, get_default_qconfig_mapping(backend), example_inputs=(calibration_inputs[0],))
+    with torch.no_grad():
+        for image in calibration_inputs:
+            prepared(image)
+    learner.backbone = FinalStackBackbone(convert_fx(prepared))
+    return quantize_dynamic(model)
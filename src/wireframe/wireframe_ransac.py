@@ -70,6 +70,126 @@ class Line3DRANSAC(wireframe.ransac.RANSAC):
                     np.multiply(np.expand_dims(params, 1), direction), axis=1)
         return error
 
+class BatchLine3DRANSAC(Line3DRANSAC):
+    """
+    BatchLine3DRANSAC
+
+    Line3DRANSAC that can also fit many point clouds at once. Each iteration draws one
+    hypothesis per cloud and scores every point of every cloud together, counting inliers
+    with segmented reductions. Like Line3DRANSAC, a hypothesis with more inliers than the
+    current best is refit to its inliers by principal components.
+
+    Attributes:
+    """
+    def __init__(self, max_iterations, inlier_thresh, good_inlier_count, seed=None):
+        super().__init__(max_iterations, inlier_thresh, good_inlier_count)
+        self._rng = np.random.default_rng(seed)
+
+    def ransac_batch(self, points, offsets):
+        """
+        Runs RANSAC on every cloud of a ragged collection of point clouds.
+
+        Arguments:
+        points -- numpy array [num_points, 3] of all clouds concatenated
+        offsets -- int numpy array [num_clouds + 1], cloud i is points[offsets[i]:offsets[i + 1]]
+
+        Returns:
+        lines -- numpy array [num_clouds, 2, 3] of the best line of each cloud,
+            NaN for clouds with fewer than 2 points
+        n_inliers -- int numpy array [num_clouds] of the inlier count of each line
+        """
+        points = np.asarray(points, dtype=np.float64).reshape((-1, 3))
+        offsets = np.asarray(offsets, dtype=int)
+        num_clouds = len(offsets) - 1
+        sizes = np.diff(offsets)
+        cloud_of = np.repeat(np.arange(num_clouds), sizes)
+
+        lines = np.full((num_clouds, 2, 3), np.nan)
+        n_inliers = np.zeros(num_clouds, dtype=int)
+        # Clouds still being improved
+        active = sizes >= self.n
+        if not np.any(active):
+            return lines, n_inliers
+
+        for iteration in range(self.k):
+            clouds = np.nonzero(active)[0]
+            if len(clouds) == 0:
+                break
+            # Two distinct samples per cloud
+            n = sizes[clouds]
+            i = np.minimum((self._rng.random(len(clouds)) * n).astype(int), n - 1)
+            j = np.minimum((self._rng.random(len(clouds)) * (n - 1)).astype(int), n - 2)
+            j += j >= i
+            model = np.stack([points[offsets[clouds] + i], points[offsets[clouds] + j]], axis=1)
+
+            hypotheses = np.full((num_clouds, 2, 3), np.nan)
+            hypotheses[clouds] = model
+            inliers = self._batch_error(points, cloud_of, hypotheses) < self.t
+            counts = np.bincount(cloud_of[inliers], minlength=num_clouds)
+
+            if iteration == 0:
+                # Initialize with the hypotheses (don't bother with refitting)
+                lines[clouds] = model
+                n_inliers[clouds] = counts[clouds]
+            else:
+                improve = active & (counts > n_inliers)
+                if np.any(improve):
+                    # Choose best model as the one that fits all of these inliers
+                    refit = self._batch_fit(points, cloud_of, inliers & improve[cloud_of], improve)
+                    lines[improve] = refit[improve]
+                    in_improved = improve[cloud_of]
+                    refit_inliers = np.zeros(len(points), dtype=bool)
+                    refit_inliers[in_improved] = self._batch_error(points[in_improved], cloud_of[in_improved], refit) < self.t
+                    n_inliers[improve] = np.bincount(cloud_of[refit_inliers], minlength=num_clouds)[improve]
+
+            # Shortcut clouds with a good enough number of inliers
+            if self.d is not None:
+                active &= n_inliers <= self.d
+
+        return lines, n_inliers
+
+    def _batch_error(self, points, cloud_of, lines):
+        # get_error for each point against the line of its cloud, NaN for degenerate lines
+        point = lines[cloud_of, 0]
+        direction = lines[:, 1] - lines[:, 0]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            direction = direction / np.linalg.norm(direction, axis=1, keepdims=True)
+            direction = direction[cloud_of]
+            diff = points - point
+            params = np.sum(diff * direction, axis=1)
+            return np.linalg.norm(diff - params[:, None] * direction, axis=1)
+
+    def _batch_fit(self, points, cloud_of, selected, clouds):
+        # fit for each cloud in the clouds mask, using the selected points of that cloud.
+        # Every cloud in the mask must have at least one selected point.
+        num_clouds = len(clouds)
+        idx = np.nonzero(selected)[0]
+        owner = cloud_of[idx]
+        counts = np.bincount(owner, minlength=num_clouds)
+
+        mean = np.zeros((num_clouds, 3))
+        for axis in range(3):
+            mean[:, axis] = np.bincount(owner, weights=points[idx, axis], minlength=num_clouds)
+        mean[clouds] /= counts[clouds, None]
+        centered = points[idx] - mean[owner]
+
+        # Principal direction from the scatter matrix of each cloud
+        scatter = np.zeros((num_clouds, 3, 3))
+        for a in range(3):
+            for b in range(a, 3):
+                scatter[:, a, b] = np.bincount(owner, weights=centered[:, a] * centered[:, b], minlength=num_clouds)
+                scatter[:, b, a] = scatter[:, a, b]
+        direction = np.zeros((num_clouds, 3))
+        direction[clouds] = np.linalg.eigh(scatter[clouds])[1][:, :, -1]
+
+        # Project points to line to find the needed endpoints. Selected points are grouped by cloud.
+        params = np.sum(centered * direction[owner], axis=1)
+        starts = np.concatenate([[0], np.cumsum(counts[clouds])[:-1]])
+        lines = np.full((num_clouds, 2, 3), np.nan)
+        lines[clouds, 0] = mean[clouds] + direction[clouds] * np.minimum.reduceat(params, starts)[:, None]
+        lines[clouds, 1] = mean[clouds] + direction[clouds] * np.maximum.reduceat(params, starts)[:, None]
+        return lines
+
 class ManhattanRANSAC(wireframe.ransac.RANSAC):
     """
     ManhattanRANSAC
@@ -10,6 +10,7 @@ import os
 import numpy as np
 
 import wireframe.project
+import wireframe.segment_index
 
 class WireframeRecord():
     """
@@ -27,38 +28,68 @@ class WireframeRecord():
     scores -- returns the scores of the line information
     juncs -- returns the junction information with endpoints in [0,1] x [0,1]
     postprocess -- runs the LCNN postprocess function on the lines and scores
+    deduplicated -- cached LCNN postprocess output for an overlap tolerance
+    num_above -- number of lines with score above a threshold
+    segment_index -- lazily built spatial index over the deduplicated lines
+
+    Lines are kept sorted by descending score, so lines above a threshold are a prefix.
     """
-    def __init__(self, preds, imshape, imnum, to_cpu=True):
+    def __init__(self, preds, imshape, imnum, to_cpu=True, index=0, num_lines=None, num_juncs=None, copy=True):
         """
         Initialize the wireframe record with the predictions of the LCNN model
+
+        Arguments:
+        preds -- LCNN predictions (batched tensors) or loaded numpy data
+        imshape -- shape of the image that generated the predictions
+        imnum -- image number
+        to_cpu -- preds are batched tensors that need to be moved to the cpu (default True)
+        index -- which image of the batch to use when to_cpu is True (default 0)
+        num_lines, num_juncs -- (optional) number of valid lines and junctions in preds.
+            Taken from preds["n_lines"] and preds["n_juncs"] for compact LCNN output.
+            If unknown they are recovered from the padding of older outputs.
+        copy -- copy numpy data when to_cpu is False (default True).
+            If False the record is a view of the arrays, e.g. into a WireframeRecordStore
         """
         self.preds = preds
         self.imshape = (imshape[0], imshape[1])
         self.imnum = imnum
         if to_cpu:
-            self._lines = self.preds["lines"][0].cpu().numpy()
-            self._score = self.preds["score"][0].cpu().numpy()
-            self._juncs = self.preds["juncs"][0].cpu().numpy()
+            self._lines = self.preds["lines"][index].cpu().numpy()
+            self._score = self.preds["score"][index].cpu().numpy()
+            self._juncs = self.preds["juncs"][index].cpu().numpy()
+            if "n_lines" in self.preds:
+                num_lines = int(self.preds["n_lines"][index])
+                num_juncs = int(self.preds["n_juncs"][index])
         else:
-            self._lines = np.array(self.preds["lines"], copy=True)
-            self._score = np.array(self.preds["score"], copy=True)
-            self._juncs = np.array(self.preds["juncs"], copy=True)
-
-        self.num_lines = None
-        for i in range(1, len(self._lines)):
-            if (self._lines[i] == self._lines[0]).all():
-                self.num_lines = i
-                break
-        if self.num_lines is None:
-            self.num_lines = len(self._lines)
-
-        self.num_juncs = None
-        for i in range(1, len(self._juncs)):
-            if (self._juncs[i] == self._juncs[0]).all():
-                self.num_juncs = i
-                break
-        if self.num_juncs is None:
-            self.num_juncs = len(self._juncs)
+            self._lines = np.array(self.preds["lines"], copy=True) if copy else self.preds["lines"]
+            self._score = np.array(self.preds["score"], copy=True) if copy else self.preds["score"]
+            self._juncs = np.array(self.preds["juncs"], copy=True) if copy else self.preds["juncs"]
+
+        if num_lines is None:
+            num_lines = padded_length(self._lines)
+        if num_juncs is None:
+            num_juncs = padded_length(self._juncs)
+        self.num_lines = num_lines
+        self.num_juncs = num_juncs
+        # Only keep the valid entries
+        self._lines = self._lines[:self.num_lines]
+        self._score = self._score[:self.num_lines]
+        self._juncs = self._juncs[:self.num_juncs]
+
+        # Keep lines sorted by descending score so score thresholds select a prefix.
+        # LCNN already sorts its output so this is normally a no-op.
+        if np.any(np.diff(self._score) > 0):
+            order = np.argsort(-self._score, kind="stable")
+            self._lines = self._lines[order]
+            self._score = self._score[order]
+
+        # Cache from overlap tolerance -> (nlines, nscores) postprocess output
+        self._postprocessed = {}
+        # Ascending negated scores for binary searching thresholds, keyed like _postprocessed
+        # with None for the raw lines
+        self._score_index = {}
+        # Cache from overlap tolerance -> SegmentIndex over the deduplicated lines
+        self._segment_index = {}
 
     ##########################
     # Getter functions here
@@ -89,33 +120,109 @@ class WireframeRecord():
     # Utility functions here
     ##########################
 
-    def postprocess(self, threshold=0):
+    def postprocess(self, threshold=0, overlap=0.01):
         """
         Filters the lines to remove close duplicates in the image.
 
+        The deduplicated lines are computed once per overlap tolerance and cached,
+        so repeated calls with different thresholds only filter by score.
+
         Arguments:
-        imshape -- image dimensions
         threshold -- returned lines must have greater score (default 0)
+        overlap -- lines closer than overlap * image diagonal are duplicates (default 0.01)
 
         Returns:
-        nlines -- filtered lines
+        nlines -- filtered lines, a read only view sorted by descending score
         nscores -- filtered scores
         """
-        diag = (self.imshape[0] ** 2 + self.imshape[1] ** 2) ** 0.5
-        # Multiply lines by image shape to get image point coordinates
-        nlines, nscores = postprocess(self.lines() * self.imshape[:2], self.scores(), diag * 0.01, 0, False)
-        return nlines[nscores > threshold], nscores[nscores > threshold]
+        nlines, nscores = self.deduplicated(overlap)
+        n = self.num_above(threshold, overlap)
+        return nlines[:n], nscores[:n]
+
+    def num_above(self, threshold, overlap=None):
+        """
+        Returns the number of lines with score greater than threshold using a binary search
+
+        Arguments:
+        threshold -- score threshold
+        overlap -- count deduplicated lines for this overlap tolerance (see deduplicated).
+            If None counts the raw predicted lines (default None)
+        """
+        if overlap not in self._score_index:
+            scores = self._score if overlap is None else self.deduplicated(overlap)[1]
+            self._score_index[overlap] = -np.asarray(scores, dtype=np.float64)
+        return int(np.searchsorted(self._score_index[overlap], -threshold, side="left"))
+
+    def deduplicated(self, overlap=0.01):
+        """
+        Returns the cached LCNN postprocess output for the overlap tolerance.
+        The returned arrays are shared and must not be modified.
+
+        Arguments:
+        overlap -- lines closer than overlap * image diagonal are duplicates (default 0.01)
+
+        Returns:
+        nlines -- deduplicated lines in image point coordinates
+        nscores -- their scores
+        """
+        if overlap not in self._postprocessed:
+            diag = (self.imshape[0] ** 2 + self.imshape[1] ** 2) ** 0.5
+            # Multiply lines by image shape to get image point coordinates
+            nlines, nscores = postprocess(self.lines() * self.imshape[:2], self.scores(), diag * overlap, 0, False)
+            self._set_postprocessed(overlap, nlines, nscores)
+        return self._postprocessed[overlap]
 
-    def save(self, filename):
+    def segment_index(self, overlap=0.01):
+        """
+        Returns a spatial index over the deduplicated lines in image point coordinates,
+        built on first use. Index i refers to line i of deduplicated(overlap), which is
+        also line i of postprocess(threshold, overlap) for every threshold. Pass
+        limit=num_above(threshold, overlap) to queries to only consider lines above threshold.
+
+        Arguments:
+        overlap -- overlap tolerance of the indexed lines (default 0.01)
+
+        Returns:
+        index -- wireframe.segment_index.SegmentIndex
+        """
+        if overlap not in self._segment_index:
+            nlines, _ = self.deduplicated(overlap)
+            self._segment_index[overlap] = wireframe.segment_index.SegmentIndex(nlines, self.imshape)
+        return self._segment_index[overlap]
+
+    def _set_postprocessed(self, overlap, nlines, nscores):
+        # Postprocess keeps the descending score order of its input.
+        # Cached arrays are shared by every caller so they are made read only.
+        nlines = np.asarray(nlines).reshape(-1, 2, 2)
+        nlines.flags.writeable = False
+        nscores.flags.writeable = False
+        self._postprocessed[overlap] = (nlines, nscores)
+        self._score_index.pop(overlap, None)
+        self._segment_index.pop(overlap, None)
+
+    def save(self, filename, postprocessed=False):
         """
         Saves the record in numpy format for later use loading with WireframeRecord.load
 
         Arguments:
         filename -- file to write. Will create directories. Overwrites destination. Appends .npz
+        postprocessed -- also save the cached postprocess output so it is not recomputed after loading.
+            If nothing is cached the default overlap tolerance is computed first (default False)
         """
         directory = os.path.dirname(filename)
         os.makedirs(directory, exist_ok=True)
-        np.savez_compressed(filename, lines=self._lines, score=self._score, juncs=self._juncs, imshape=self.imshape)
+        arrays = {}
+        if postprocessed:
+            if not self._postprocessed:
+                self.deduplicated()
+            overlaps = sorted(self._postprocessed.keys())
+            arrays["postprocess_overlap"] = np.array(overlaps)
+            for i, overlap in enumerate(overlaps):
+                nlines, nscores = self._postprocessed[overlap]
+                arrays["postprocess_lines_{}".format(i)] = nlines
+                arrays["postprocess_score_{}".format(i)] = nscores
+        np.savez_compressed(filename, lines=self._lines, score=self._score, juncs=self._juncs, imshape=self.imshape,
+                            num_lines=self.num_lines, num_juncs=self.num_juncs, **arrays)
 
     ##########################
     # Static class functions here
@@ -131,6 +238,25 @@ class WireframeRecord():
         record = None
         with open(filename, 'rb') as f:
             data = np.load(filename)
-            record = WireframeRecord(data, data["imshape"], imnum, to_cpu=False)
+            num_lines, num_juncs = None, None
+            if "num_lines" in data.files:
+                num_lines = int(data["num_lines"])
+                num_juncs = int(data["num_juncs"])
+            record = WireframeRecord(data, data["imshape"], imnum, to_cpu=False,
+                                     num_lines=num_lines, num_juncs=num_juncs)
+            if "postprocess_overlap" in data.files:
+                for i, overlap in enumerate(data["postprocess_overlap"]):
+                    record._set_postprocessed(float(overlap), data["postprocess_lines_{}".format(i)],
+                                              data["postprocess_score_{}".format(i)])
             data.close()
         return record
+
+def padded_length(arr):
+    """
+    Returns the number of valid entries in an LCNN output padded by repeating entries,
+    i.e. the index of the first repeat of arr[0] (or len(arr) if it is not repeated)
+    """
+    for i in range(1, len(arr)):
+        if (arr[i] == arr[0]).all():
+            return i
+    return len(arr)
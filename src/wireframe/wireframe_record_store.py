@@ -0,0 +1,155 @@
+#
+# wireframe_record_store.py
+#
+# Declares the WireframeRecordStore class that stores the wireframe records of a whole
+# project in a few memory-mappable arrays
+#
+
+import json
+import os
+
+import numpy as np
+
+import wireframe.wireframe_record
+
+# Columns of the index array
+INDEX_COLUMNS = ["imnum", "line_start", "line_end", "junc_start", "junc_end", "height", "width"]
+
+class WireframeRecordStore():
+    """
+    WireframeRecordStore
+
+    Columnar storage for the wireframe records of a project. The lines, scores and
+    junctions of every record are concatenated into uncompressed .npy files that are
+    memory-mapped on load, with an index of offsets per image. Records returned by the
+    store are views into the mapped arrays, so loading is independent of the number
+    of lines.
+
+    Files in the store directory:
+    lines.npy -- float32 [total_lines, 2, 2]
+    score.npy -- float32 [total_lines]
+    juncs.npy -- float32 [total_juncs, 2]
+    index.npy -- int64 [num_records, 7] with columns INDEX_COLUMNS
+    imnames.json -- list of image filenames, one per index row
+    sources.json -- dict from imname -> description of the record each row was built from
+
+    Attributes:
+    directory -- the store directory
+    imnames -- list of image filenames in the store
+    sources -- dict from imname -> source given to write, compared by the caller to
+        detect stale rows (empty for stores written without sources)
+    """
+    def __init__(self, directory):
+        """
+        Opens an existing store
+
+        Arguments:
+        directory -- store directory written by WireframeRecordStore.write
+        """
+        self.directory = directory
+        self._lines = np.load(os.path.join(directory, "lines.npy"), mmap_mode="r")
+        self._score = np.load(os.path.join(directory, "score.npy"), mmap_mode="r")
+        self._juncs = np.load(os.path.join(directory, "juncs.npy"), mmap_mode="r")
+        self._index = np.load(os.path.join(directory, "index.npy"))
+        with open(os.path.join(directory, "imnames.json"), 'r') as f:
+            self.imnames = json.load(f)
+        self.sources = {}
+        if os.path.isfile(os.path.join(directory, "sources.json")):
+            with open(os.path.join(directory, "sources.json"), 'r') as f:
+                self.sources = json.load(f)
+        self._row_by_imname = {imname: i for i, imname in enumerate(self.imnames)}
+        self._row_by_imnum = {int(imnum): i for i, imnum in enumerate(self._index[:, 0])}
+
+    def __len__(self):
+        return len(self.imnames)
+
+    def __contains__(self, imname):
+        return imname in self._row_by_imname
+
+    def record(self, row):
+        """
+        Returns the WireframeRecord for an index row as a view into the store
+        """
+        imnum, line_start, line_end, junc_start, junc_end, height, width = self._index[row]
+        data = {
+            "lines": self._lines[line_start:line_end],
+            "score": self._score[line_start:line_end],
+            "juncs": self._juncs[junc_start:junc_end],
+        }
+        return wireframe.wireframe_record.WireframeRecord(data, (height, width), int(imnum), to_cpu=False,
+                num_lines=int(line_end - line_start), num_juncs=int(junc_end - junc_start), copy=False)
+
+    def get(self, imname):
+        """
+        Returns the WireframeRecord for an image filename
+        """
+        return self.record(self._row_by_imname[imname])
+
+    def get_by_imnum(self, imnum):
+        """
+        Returns the WireframeRecord for an image number
+        """
+        return self.record(self._row_by_imnum[imnum])
+
+    def records(self):
+        """
+        Returns a dict from imname -> WireframeRecord for every record in the store
+        """
+        return {imname: self.record(i) for i, imname in enumerate(self.imnames)}
+
+    ##########################
+    # Static class functions here
+    ##########################
+
+    @staticmethod
+    def exists(directory):
+        return os.path.isfile(os.path.join(directory, "imnames.json"))
+
+    @staticmethod
+    def write(directory, records, sources=None):
+        """
+        Writes a store from the records. Overwrites an existing store.
+
+        Arguments:
+        directory -- store directory. Will be created
+        records -- dict from imname -> WireframeRecord
+        sources -- (optional) dict from imname -> JSON serializable description of the
+            record's source, e.g. from wireframe.project.record_source
+
+        Returns:
+        store -- the opened WireframeRecordStore
+        """
+        os.makedirs(directory, exist_ok=True)
+        imnames = sorted(records.keys())
+        index = np.zeros((len(imnames), len(INDEX_COLUMNS)), dtype=np.int64)
+        lines, score, juncs = [], [], []
+        num_lines, num_juncs = 0, 0
+        for i, imname in enumerate(imnames):
+            rec = records[imname]
+            index[i] = [rec.imnum, num_lines, num_lines + rec.num_lines, num_juncs, num_juncs + rec.num_juncs,
+                        rec.imshape[0], rec.imshape[1]]
+            lines.append(np.asarray(rec._lines[:rec.num_lines], dtype=np.float32).reshape(-1, 2, 2))
+            score.append(np.asarray(rec._score[:rec.num_lines], dtype=np.float32).reshape(-1))
+            juncs.append(np.asarray(rec._juncs[:rec.num_juncs], dtype=np.float32).reshape(-1, 2))
+            num_lines += rec.num_lines
+            num_juncs += rec.num_juncs
+
+        # Files are written to temporary names and renamed so stores that are already
+        # mapped keep their data. imnames.json is replaced last and marks the store complete.
+        arrays = {
+            "lines.npy": np.concatenate(lines) if lines else np.zeros((0, 2, 2), dtype=np.float32),
+            "score.npy": np.concatenate(score) if score else np.zeros(0, dtype=np.float32),
+            "juncs.npy": np.concatenate(juncs) if juncs else np.zeros((0, 2), dtype=np.float32),
+            "index.npy": index,
+        }
+        for fname, arr in arrays.items():
+            with open(os.path.join(directory, fname + ".tmp"), 'wb') as f:
+                np.save(f, arr)
+        with open(os.path.join(directory, "sources.json.tmp"), 'w') as f:
+            json.dump(sources if sources is not None else {}, f)
+        for fname in list(arrays) + ["sources.json"]:
+            os.replace(os.path.join(directory, fname + ".tmp"), os.path.join(directory, fname))
+        with open(os.path.join(directory, "imnames.json.tmp"), 'w') as f:
+            json.dump(imnames, f)
+        os.replace(os.path.join(directory, "imnames.json.tmp"), os.path.join(directory, "imnames.json"))
+        return WireframeRecordStore(directory)
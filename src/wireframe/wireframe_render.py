@@ -0,0 +1,144 @@
+#
+# wireframe_render.py
+#
+# Headless rendering of wireframe diagnostics to PNG files from a pool of worker processes
+#
+
+import collections
+import concurrent.futures
+import functools
+import multiprocessing
+import os
+
+import numpy as np
+
+class WireframeRenderer():
+    """
+    WireframeRenderer
+
+    Renders figures to PNG files in worker processes using the Agg backend, so plotting
+    never blocks the pipeline on a window. Jobs are queued with submit. At most max_pending
+    jobs are in flight and submit waits for the oldest one when the queue is full.
+
+    A figure is a grid of panels. Each panel is a dict with keys:
+    image -- image array or filename, loaded once per worker
+    segments -- numpy array [num_segments, 2, 2] of (x, y) plot coordinates
+    colors -- (optional) one matplotlib color per segment or a single color (default 'r')
+    points -- (optional) draw segment endpoints (default False)
+
+    Attributes:
+    out_dir -- directory PNG files are written to
+    num_procs -- number of worker processes
+    """
+    def __init__(self, out_dir, num_procs=2, max_pending=16):
+        """
+        Arguments:
+        out_dir -- directory PNG files are written to, created if missing
+        num_procs -- number of worker processes (default 2)
+        max_pending -- maximum number of queued or running jobs (default 16)
+        """
+        self.out_dir = out_dir
+        self.num_procs = num_procs
+        self.max_pending = max(1, max_pending)
+        os.makedirs(out_dir, exist_ok=True)
+        ctx = multiprocessing.get_context("spawn")
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=num_procs, mp_context=ctx, initializer=_init_worker)
+        self._pending = collections.deque()
+        self.rendered = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def submit(self, filename, panels, shape=None):
+        """
+        Queues a figure to be rendered
+
+        Arguments:
+        filename -- PNG filename, relative to out_dir
+        panels -- list of panel dicts
+        shape -- (optional) (rows, cols) of the panel grid (default one row)
+        """
+        while len(self._pending) >= self.max_pending:
+            self._finish(self._pending.popleft())
+        path = os.path.join(self.out_dir, filename)
+        self._pending.append(self._executor.submit(render_panels, panels, shape, path))
+
+    def close(self):
+        """
+        Waits for every queued figure and shuts down the worker processes
+        """
+        while self._pending:
+            self._finish(self._pending.popleft())
+        self._executor.shutdown()
+        print("Rendered {} figures to {}".format(self.rendered, self.out_dir))
+
+    def _finish(self, future):
+        future.result()
+        self.rendered += 1
+
+###############################################################
+# Utility functions
+###############################################################
+
+def _init_worker():
+    import matplotlib
+    matplotlib.use("Agg")
+
+@functools.lru_cache(maxsize=16)
+def _load_image(filename):
+    import matplotlib.pyplot as plt
+
+    return plt.imread(filename)
+
+def draw_panel(ax, panel):
+    """
+    Draws a panel on a matplotlib axis, with all segments in one LineCollection
+
+    Arguments:
+    ax -- matplotlib axis
+    panel -- panel dict, see WireframeRenderer
+    """
+    from matplotlib.collections import LineCollection
+    from wireframe.wireframe_plot import PLTOPTS
+
+    image = panel.get("image", None)
+    if isinstance(image, str):
+        image = _load_image(image)
+    if image is not None:
+        ax.imshow(image, cmap="gray" if image.ndim == 2 else None)
+    segments = np.asarray(panel.get("segments", np.zeros((0, 2, 2))), dtype=np.float64).reshape((-1, 2, 2))
+    ax.add_collection(LineCollection(segments, colors=panel.get("colors", 'r'), linewidths=2))
+    if panel.get("points", False) and len(segments) > 0:
+        pts = segments.reshape((-1, 2))
+        ax.scatter(pts[:, 0], pts[:, 1], **PLTOPTS)
+    if image is None:
+        ax.autoscale()
+    ax.set_axis_off()
+
+def render_panels(panels, shape=None, filename=None):
+    """
+    Draws a grid of panels and writes it to filename, or shows it if filename is None
+
+    Arguments:
+    panels -- list of panel dicts, see WireframeRenderer
+    shape -- (optional) (rows, cols) of the panel grid (default one row)
+    filename -- (optional) PNG file to write
+    """
+    import matplotlib.pyplot as plt
+
+    rows, cols = shape if shape is not None else (1, len(panels))
+    fig, axes = plt.subplots(rows, cols, squeeze=False)
+    fig.subplots_adjust(top=1, bottom=0, right=1, left=0, hspace=0, wspace=0)
+    for ax in axes.flat[len(panels):]:
+        ax.set_axis_off()
+    for ax, panel in zip(axes.flat, panels):
+        draw_panel(ax, panel)
+    if filename is None:
+        plt.show()
+    else:
+        fig.savefig(filename, bbox_inches="tight", pad_inches=0)
+    plt.close(fig)
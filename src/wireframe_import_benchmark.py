@@ -0,0 +1,54 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# Modules that must not be loaded just by importing the light weight packages
+HEAVY_MODULES = ["torch", "matplotlib", "cv2", "igraph", "skimage", "yaml", "tensorboardX"]
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+for name in {modules}:
+    __import__(name)
+elapsed = time.perf_counter() - start
+print(json.dumps({{"time": elapsed, "loaded": sorted(m for m in {heavy} if m in sys.modules)}}))
+"""
+
+def measure(modules, repeat):
+    """
+    Imports modules in fresh interpreters and returns the best import time and
+    the heavy modules that were loaded as a side effect.
+    """
+    src_dir = os.path.dirname(os.path.abspath(__file__))
+    code = PROBE.format(modules=repr(modules), heavy=repr(HEAVY_MODULES))
+    best = None
+    loaded = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", code], cwd=src_dir, check=True,
+                             capture_output=True, text=True).stdout
+        result = json.loads(out.strip().splitlines()[-1])
+        best = result["time"] if best is None else min(best, result["time"])
+        loaded = result["loaded"]
+    return best, loaded
+
+def main(args):
+    failed = False
+    for modules in [["wireframe"], ["myply"], ["wireframe", "myply"]]:
+        t, loaded = measure(modules, args.repeat)
+        print("import {}: {:.3f} s".format(", ".join(modules), t))
+        if loaded:
+            print("  FAIL: loaded heavy modules {}".format(", ".join(loaded)))
+            failed = True
+        if t > args.budget:
+            print("  FAIL: over the {:.3f} s budget".format(args.budget))
+            failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--budget', type=float, default=0.5, help="maximum allowed import time in seconds")
+    parser.add_argument('--repeat', type=int, default=3, help="number of fresh interpreters to time")
+    args = parser.parse_args()
+    main(args)
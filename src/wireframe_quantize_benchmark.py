@@ -0,0 +1,86 @@
+import wireframe
+import utils
+import argparse
+import os
+import time
+
+import numpy as np
+
+def match_fraction(ref, other, tol):
+    """
+    Returns the fraction of ref elements with an element of other within tol pixels.
+
+    Arguments:
+    ref, other -- numpy arrays of lines [N, 2, 2] or junctions [N, 2] in pixels
+    tol -- maximum distance between matched endpoints
+    """
+    if len(ref) == 0:
+        return 1.0
+    if len(other) == 0:
+        return 0.0
+    ref = ref.reshape(len(ref), 1, -1)
+    other = other.reshape(1, len(other), -1)
+    dist = np.abs(ref - other).max(axis=2)
+    if ref.shape[2] == 4:
+        # Lines match in either endpoint order
+        flipped = other.reshape(1, other.shape[1], 2, 2)[:, :, ::-1].reshape(1, other.shape[1], 4)
+        dist = np.minimum(dist, np.abs(ref - flipped).max(axis=2))
+    return np.mean(dist.min(axis=1) < tol)
+
+def time_parse(w, imnames):
+    records = []
+    start = time.perf_counter()
+    for imname in imnames:
+        records.append(w.parse(imname))
+    return records, (time.perf_counter() - start) / len(imnames)
+
+def main(args):
+    # Filepaths
+    config_file = utils.data("wireframe.yaml")
+    model_file = utils.data("pretrained_lcnn.pth.tar")
+
+    imnames = wireframe.project.list_project_images(args.project_directory)
+    imnames = [os.path.join(args.project_directory, wireframe.project.DIR_IMAGES, imname) for imname in imnames]
+    calibration = imnames[:args.calibration]
+    imnames = imnames[args.calibration:args.calibration + args.n]
+    if len(imnames) == 0:
+        print("No images to benchmark")
+        return
+
+    fp32 = wireframe.Wireframe(config_file, model_file, "", num_threads=args.threads)
+    int8 = wireframe.Wireframe(config_file, model_file, "", num_threads=args.threads)
+    if not fp32.setup():
+        print(fp32.error)
+        return
+    if not int8.setup(quantize=args.mode, calibration_images=calibration):
+        print(int8.error)
+        return
+
+    fp32_recs, fp32_time = time_parse(fp32, imnames)
+    int8_recs, int8_time = time_parse(int8, imnames)
+
+    line_agreement = []
+    junc_agreement = []
+    for a, b in zip(fp32_recs, int8_recs):
+        a_lines, _ = a.postprocess(args.score_thresh)
+        b_lines, _ = b.postprocess(args.score_thresh)
+        line_agreement.append(match_fraction(a_lines, b_lines, args.tol))
+        junc_agreement.append(match_fraction(a.juncs() * a.imshape, b.juncs() * b.imshape, args.tol))
+
+    print("Benchmarked {} images ({} quantization, {} calibration images)".format(len(imnames), args.mode, len(calibration)))
+    print("fp32 latency: {:.3f} s/image".format(fp32_time))
+    print("int8 latency: {:.3f} s/image ({:.2f}x speedup)".format(int8_time, fp32_time / int8_time))
+    print("Line agreement (score > {}): {:.3f}".format(args.score_thresh, np.mean(line_agreement)))
+    print("Junction agreement: {:.3f}".format(np.mean(junc_agreement)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('project_directory', type=str, help="directory storing all image data")
+    parser.add_argument('--mode', type=str, default="dynamic", choices=["dynamic", "static"], help="quantization mode")
+    parser.add_argument('-n', type=int, default=20, help="number of images to benchmark")
+    parser.add_argument('--calibration', type=int, default=8, help="number of images used for static calibration")
+    parser.add_argument('--threads', type=int, default=None, help="number of torch threads")
+    parser.add_argument('--score_thresh', type=float, default=0.95, help="Score threshold for compared lines")
+    parser.add_argument('--tol', type=float, default=5.0, help="Pixel tolerance for matching lines and junctions")
+    args = parser.parse_args()
+    main(args)
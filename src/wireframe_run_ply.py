@@ -21,13 +21,28 @@ def main(args):
     config_file = utils.data("wireframe.yaml")
     model_file = utils.data("pretrained_lcnn.pth.tar")
 
-    w = wireframe.Wireframe(config_file, model_file, args.device)
-    if not w.setup():
-        print(w.error)
-    else:
-        print("w is setup successfully")
+    # Only load the model (and torch) when records are missing or stale
+    model_key = wireframe.project.model_key(config_file, model_file, args.project_directory)
+    to_generate = wireframe.project.missing_wireframe_records(args.project_directory, force=args.recompute,
+            model_key=model_key)
+    w = None
+    if to_generate:
+        w = wireframe.Wireframe(config_file, model_file, args.device)
+        # With multiple processes each worker sets up its own copy of the model
+        if args.procs <= 1:
+            if not w.setup(use_cache=args.cache_model):
+                print(w.error)
+            else:
+                print("w is setup successfully")
 
-    records = wireframe.project.generate_wireframe_records(args.project_directory, w, force=args.recompute)
+    records = wireframe.project.generate_wireframe_records(args.project_directory, w, force=args.recompute,
+            num_procs=args.procs,
+            use_store=args.use_store,
+            model_key=model_key,
+            to_generate=to_generate,
+            batch_size=args.batch_size,
+            use_cache=args.cache_model,
+            decode_workers=args.decode_workers)
 
     if args.reconstruction >= 0:
         reconstruction = [reconstruction[args.reconstruction]]
@@ -35,18 +50,17 @@ def main(args):
     wpcs = []
 
     for r in reconstruction:
-        for imname, iminfo in r['shots'].items():
-            print("Processing {}...".format(imname))
-            wpc = wireframe.WireframePointCloud(args.project_directory,
-                    imname,
-                    records[imname],
-                    iminfo,
-                    r['cameras'],
-                    line_inlier_thresh=args.l_thresh,
-                    color_inliers=args.color_inliers,
-                    threshold=args.score_thresh)
-            wpcs.append(wpc)
-            wpc.write_line_point_clouds()
+        # All shots of a reconstruction index into one read only point array
+        point_store = wireframe.PointStore.from_shots(r['shots'])
+        wpcs += wireframe.project.build_wireframe_point_clouds(args.project_directory,
+                records,
+                r['shots'],
+                r['cameras'],
+                point_store,
+                num_procs=args.ply_procs,
+                line_inlier_thresh=args.l_thresh,
+                color_inliers=args.color_inliers,
+                threshold=args.score_thresh)
 
     return wpcs, records
 
@@ -59,6 +73,12 @@ if __name__ == "__main__":
     parser.add_argument('--color_inliers', action="store_true", help="Use a fixed coloring scheme and indicate inliers a different color")
     parser.add_argument('--reconstruction', '-r', type=int, default=-1, help="which reconstruction to generate plys with")
     parser.add_argument('--recompute', action="store_true", help="force recomputing wireframe records")
+    parser.add_argument('--batch_size', '-b', type=int, default=1, help="number of images to run through the model at once")
+    parser.add_argument('--cache_model', action="store_true", help="load the model from a TorchScript cache next to the checkpoint")
+    parser.add_argument('--use_store', action="store_true", help="load records from the consolidated memory-mapped record store")
+    parser.add_argument('--procs', '-j', type=int, default=1, help="number of worker processes generating records")
+    parser.add_argument('--decode_workers', type=int, default=4, help="number of threads decoding images")
+    parser.add_argument('--ply_procs', type=int, default=1, help="number of worker processes building shot point clouds")
     parser.add_argument('--device', type=str, default='', help="GPU Devices")
     args = parser.parse_args()
     main(args)
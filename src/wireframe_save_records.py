@@ -4,16 +4,6 @@ import argparse
 import json
 import os
 
-def save_wireframe_records(proj_dir, w):
-    num_images = 0
-    for imname in os.listdir(os.path.join(proj_dir, "images")):
-        if imname.endswith(".png") or filename.endswith(".jpg"):
-            print("Parsing {}...".format(imname))
-            rec = w.parse(os.path.join(proj_dir, "images", imname))
-            rec.save(os.path.join(proj_dir, "wireframe_recs", "{}.rec".format(imname)))
-            num_images += 1
-    print("Saved {} wireframe records.".format(num_images))
-
 def load_wireframe_records(proj_dir):
     records = {}
     for fname in os.listdir(os.path.join(proj_dir, "wireframe_recs")):
@@ -30,16 +20,33 @@ def main(args):
     model_file = utils.data("pretrained_lcnn.pth.tar")
 
     w = wireframe.Wireframe(config_file, model_file, "")
-    if not w.setup():
-        print(w.error)
-    else:
-        print("w is setup successfully")
+    # With multiple processes each worker sets up its own copy of the model
+    if args.procs <= 1:
+        if not w.setup(use_cache=args.cache_model):
+            print(w.error)
+        else:
+            print("w is setup successfully")
 
-    save_wireframe_records(args.project_directory, w)
+    wireframe.project.save_wireframe_records(args.project_directory, w,
+            num_procs=args.procs,
+            model_key=wireframe.project.model_key(config_file, model_file, args.project_directory),
+            batch_size=args.batch_size,
+            use_cache=args.cache_model,
+            decode_workers=args.decode_workers,
+            decode_queue=args.decode_queue,
+            write_queue=args.write_queue,
+            save_postprocessed=args.save_postprocessed)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('project_directory', type=str, help="directory storing all image data")
+    parser.add_argument('--batch_size', '-b', type=int, default=1, help="number of images to run through the model at once")
+    parser.add_argument('--cache_model', action="store_true", help="load the model from a TorchScript cache next to the checkpoint")
+    parser.add_argument('--procs', '-j', type=int, default=1, help="number of worker processes generating records")
+    parser.add_argument('--decode_workers', type=int, default=4, help="number of threads decoding images")
+    parser.add_argument('--decode_queue', type=int, default=8, help="max number of decoded images waiting for the model")
+    parser.add_argument('--write_queue', type=int, default=16, help="max number of records waiting to be saved")
+    parser.add_argument('--save_postprocessed', action="store_true", help="also save deduplicated lines in each record")
     args = parser.parse_args()
     main(args)
 
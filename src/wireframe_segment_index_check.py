@@ -0,0 +1,58 @@
+import argparse
+import sys
+
+import numpy as np
+
+from wireframe.segment_index import SegmentIndex, point_segment_distance, segments_intersect_box
+
+def segments_intersect(a, b):
+    """
+    Returns True if the 2D segments a and b properly cross
+    """
+    def orient(p, q, r):
+        return np.sign((q[0] - p[0]) * (r[1] - p[1]) - (q[1] - p[1]) * (r[0] - p[0]))
+    return (orient(a[0], a[1], b[0]) != orient(a[0], a[1], b[1]) and
+            orient(b[0], b[1], a[0]) != orient(b[0], b[1], a[1]))
+
+def check(rng, extent, num_segments, queries):
+    """
+    Compares SegmentIndex queries against brute force on random segments, some of them
+    reaching past the extent like LCNN endpoints can. Returns the number of mismatches.
+    """
+    segments = rng.random((num_segments, 2, 2)) * extent * 1.4 - extent * 0.2
+    index = SegmentIndex(segments, extent, cells_per_side=int(rng.integers(1, 40)))
+    all_idx = np.arange(num_segments)
+    failures = 0
+    for _ in range(queries):
+        point = rng.random(2) * extent * 1.2 - extent * 0.1
+        r = rng.random() * extent.max() * 0.2
+        if not np.array_equal(index.near_point(point, r), all_idx[point_segment_distance(point, segments) <= r]):
+            failures += 1
+        lo = rng.random(2) * extent * 1.2 - extent * 0.1
+        hi = lo + rng.random(2) * extent * 0.3
+        if not np.array_equal(index.in_box(lo, hi), all_idx[segments_intersect_box(segments, lo, hi)]):
+            failures += 1
+    pairs = set(map(tuple, index.candidate_pairs().tolist()))
+    for i in range(num_segments):
+        for j in range(i + 1, num_segments):
+            if segments_intersect(segments[i], segments[j]) and (i, j) not in pairs:
+                failures += 1
+    return failures
+
+def main(args):
+    rng = np.random.default_rng(args.seed)
+    failures = 0
+    for _ in range(args.trials):
+        extent = np.array([rng.integers(50, 1000), rng.integers(50, 1000)], dtype=np.float64)
+        failures += check(rng, extent, int(rng.integers(0, args.segments)), args.queries)
+    print("{} trials, {} mismatches".format(args.trials, failures))
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--trials', type=int, default=50, help="number of random segment sets")
+    parser.add_argument('--segments', type=int, default=100, help="maximum number of segments per set")
+    parser.add_argument('--queries', type=int, default=20, help="point and box queries per set")
+    parser.add_argument('--seed', type=int, default=0, help="random seed")
+    args = parser.parse_args()
+    main(args)